@@ -0,0 +1,139 @@
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+def content_hash(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """text -> embedding cache keyed by a hash of (model, text), an in-memory
+    lru in front of a sqlite table on disk. both sides are capped and evict
+    the least recently used entries"""
+
+    def __init__(self, path: str, model: str, mem_size=1024, disk_size=100_000):
+        self.model = model
+        self.mem_size = mem_size
+        self.disk_size = disk_size
+        self.mem: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embedding '
+            '(key TEXT PRIMARY KEY, vec BLOB NOT NULL, used REAL NOT NULL)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS embedding_used ON embedding (used)')
+        self.disk_count = self.conn.execute(
+            'SELECT COUNT(*) FROM embedding').fetchone()[0]
+
+    def get(self, text: str) -> np.ndarray:
+        key = content_hash(self.model, text)
+        with self.lock:
+            vec = self.mem.get(key)
+            if vec is not None:
+                self.mem.move_to_end(key)
+                return vec
+            row = self.conn.execute(
+                'SELECT vec FROM embedding WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE embedding SET used = ? WHERE key = ?', (time.time(), key))
+            vec = np.frombuffer(row[0], dtype=np.float32)
+            self._put_mem(key, vec)
+            return vec
+
+    def put(self, text: str, vec):
+        key = content_hash(self.model, text)
+        vec = np.asarray(vec, dtype=np.float32)
+        with self.lock:
+            self._put_mem(key, vec)
+            cur = self.conn.execute(
+                'INSERT OR IGNORE INTO embedding (key, vec, used) VALUES (?, ?, ?)',
+                (key, vec.tobytes(), time.time()))
+            if cur.rowcount == 0:
+                self.conn.execute(
+                    'UPDATE embedding SET used = ? WHERE key = ?', (time.time(), key))
+            self.disk_count += cur.rowcount
+            if self.disk_count > self.disk_size:
+                # evict a tenth at once so inserts don't evict one by one
+                evict = self.disk_count - self.disk_size + self.disk_size // 10
+                self.conn.execute(
+                    'DELETE FROM embedding WHERE key IN '
+                    '(SELECT key FROM embedding ORDER BY used LIMIT ?)', (evict,))
+                self.disk_count = self.conn.execute(
+                    'SELECT COUNT(*) FROM embedding').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _put_mem(self, key: str, vec: np.ndarray):
+        self.mem[key] = vec
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.mem_size:
+            self.mem.popitem(last=False)
+
+
+class AnswerCache:
+    """answers keyed by a context key (prompt, history, filtered doc set),
+    a cached answer is returned for a question whose embedding is within
+    `threshold` cosine similarity of a cached one under the same key"""
+
+    def __init__(self, threshold: float, size=1000):
+        self.threshold = threshold
+        self.size = size
+        self.count = 0
+        # key -> (doc ids, normalized question vecs, answers)
+        self.buckets: OrderedDict[str, tuple[frozenset[int], np.ndarray, list[str]]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, vec) -> str:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return None
+            _, vecs, answers = bucket
+            sims = vecs @ normalize(vec)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            self.buckets.move_to_end(key)
+            return answers[best]
+
+    def put(self, key: str, doc_ids: frozenset[int], vec, answer: str):
+        vec = normalize(vec).reshape(1, -1)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = (doc_ids, vec, [answer])
+            else:
+                bucket = (doc_ids, np.vstack([bucket[1], vec]),
+                          bucket[2] + [answer])
+            self.buckets[key] = bucket
+            self.buckets.move_to_end(key)
+            self.count += 1
+            while self.count > self.size and len(self.buckets) > 1:
+                _, (_, _, answers) = self.buckets.popitem(last=False)
+                self.count -= len(answers)
+
+    def invalidate(self, doc_id: int):
+        """drop every answer that was built from `doc_id`"""
+        with self.lock:
+            for key in [k for k, b in self.buckets.items() if doc_id in b[0]]:
+                self.count -= len(self.buckets.pop(key)[2])
+
+
+def normalize(vec) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
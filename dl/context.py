@@ -0,0 +1,110 @@
+from dataclasses import dataclass
+import numpy as np
+from .embed import count_tokens
+
+
+@dataclass
+class Passage:
+    """adjacent chunks of a doc merged into one piece of context"""
+    doc_id: int
+    title: str
+    start: int  # first chunk_idx
+    end: int  # last chunk_idx
+    text: str
+    rank: int  # of the best chunk in it, 0 is the closest
+
+
+def pack_context(
+        hits: list[tuple[int, int, str, str]],
+        vecs: np.ndarray,
+        budget: int,
+        dup_threshold=0.95) -> list[Passage]:
+    """(doc_id, chunk_idx, title, text) hits in relevance order, with their
+    vecs, packed into `budget` tokens. a hit within `dup_threshold` cosine
+    similarity of a better one is dropped, the rest are taken in order while
+    they fit. hits next to each other in a doc are merged, their overlap
+    (see get_text_splitter) once. passages come in the order of their best hit"""
+    if not hits:
+        return []
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    unit = vecs / np.where(norms > 0, norms, 1)
+    sims = unit @ unit.T
+    taken, used = [], 0
+    for i, (_, _, _, text) in enumerate(hits):
+        if taken and sims[i, taken].max() >= dup_threshold:
+            continue
+        n = count_tokens(text)
+        if used + n > budget:
+            continue
+        taken.append(i)
+        used += n
+
+    passages = []
+    for i in sorted(taken, key=lambda i: (hits[i][0], hits[i][1])):
+        doc_id, chunk_idx, title, text = hits[i]
+        last = passages[-1] if passages else None
+        if last is not None and last.doc_id == doc_id and last.end + 1 == chunk_idx:
+            last.text = merge_overlap(last.text, text)
+            last.end = chunk_idx
+            last.rank = min(last.rank, i)
+        else:
+            passages.append(Passage(doc_id, title, chunk_idx, chunk_idx, text, i))
+    return sorted(passages, key=lambda p: p.rank)
+
+
+def mmr(
+        query: np.ndarray,
+        vecs: np.ndarray,
+        k: int,
+        lambda_=0.7,
+        groups: np.ndarray = None,
+        cap=0) -> np.ndarray:
+    """indexes of up to `k` of `vecs` in maximal marginal relevance order:
+    every pick maximizes lambda_ * its cosine similarity to `query` minus
+    (1 - lambda_) * its highest similarity to the ones picked before. with
+    `cap`, at most `cap` of the same `groups` value are picked"""
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    unit = vecs / np.where(norms > 0, norms, 1)
+    q = query / (np.linalg.norm(query) or 1)
+    relevance = lambda_ * (unit @ q)
+    sims = unit @ unit.T
+    redundancy = np.zeros(len(vecs), dtype=sims.dtype)
+    available = np.ones(len(vecs), dtype=bool)
+    counts = {}
+    picked = []
+    while len(picked) < k and available.any():
+        score = np.where(available, relevance - (1 - lambda_) * redundancy, -np.inf)
+        i = int(np.argmax(score))
+        picked.append(i)
+        available[i] = False
+        redundancy = np.maximum(redundancy, sims[i])
+        if cap and groups is not None:
+            g = groups[i]
+            counts[g] = counts.get(g, 0) + 1
+            if counts[g] >= cap:
+                available &= groups != g
+    return np.array(picked, dtype=np.int64)
+
+
+def merge_overlap(a: str, b: str, min_overlap=8, max_overlap=200) -> str:
+    """`a` followed by `b` without the text `b` starts with that `a` ends with"""
+    for k in range(min(len(a), len(b), max_overlap), min_overlap - 1, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return a + ' ' + b
+
+
+def trim_history(history: list[str], budget: int) -> list[str]:
+    """the latest whole messages of `history` that fit in `budget` tokens,
+    starting at a question"""
+    kept, used = [], 0
+    for msg in reversed(history):
+        n = count_tokens(msg)
+        if used + n > budget:
+            break
+        kept.append(msg)
+        used += n
+    kept.reverse()
+    while kept and not kept[0].startswith('usr:'):
+        kept.pop(0)
+    return kept
@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import random
+import re
+import threading
+import time
+import zlib
+import numpy as np
+
+
+class TokenBucket:
+    """a tokens per minute budget, `acquire` blocks until it's available.
+    a request bigger than the whole budget waits for a full bucket"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+
+    def acquire(self, n: int):
+        n = min(n, self.capacity)
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.capacity / 60)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                self.cond.wait((n - self.tokens) * 60 / self.capacity)
+
+
+class EmbeddingClient:
+    """embeds texts in batches sized by token count, up to `concurrency`
+    batches in flight under a `tpm` tokens per minute budget. a failed batch
+    is retried when `retryable(e)` with jittered exponential backoff.
+    `embed_batch(texts)` does one request, results come back in input order"""
+
+    def __init__(
+            self,
+            embed_batch: Callable[[list[str]], list[list[float]]],
+            retryable: Callable[[Exception], bool],
+            concurrency=4,
+            tpm=1_000_000,
+            batch_tokens=50_000,
+            retries=6,
+            backoff=1.0,
+            max_backoff=60.0):
+        self.embed_batch = embed_batch
+        self.retryable = retryable
+        self.concurrency = concurrency
+        self.budget = TokenBucket(tpm)
+        self.batch_tokens = batch_tokens
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def embed(self, texts: list[str], batch_size=2048) -> np.ndarray:
+        batches = self.batches(texts, batch_size)
+        if len(batches) <= 1 or self.concurrency <= 1:
+            rets = [self._embed(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(min(self.concurrency, len(batches))) as pool:
+                rets = list(pool.map(self._embed, batches))
+        return np.array([vec for ret in rets for vec in ret], dtype=np.float32)
+
+    def batches(self, texts: list[str], batch_size: int) -> list[tuple[list[str], int]]:
+        """(texts, tokens) batches of at most `batch_size` texts and
+        `batch_tokens` tokens, a longer text is a batch of its own"""
+        batches, batch, tokens = [], [], 0
+        for text in texts:
+            n = count_tokens(text)
+            if batch and (len(batch) >= batch_size or tokens + n > self.batch_tokens):
+                batches.append((batch, tokens))
+                batch, tokens = [], 0
+            batch.append(text)
+            tokens += n
+        if batch:
+            batches.append((batch, tokens))
+        return batches
+
+    def _embed(self, batch: tuple[list[str], int]) -> list[list[float]]:
+        texts, tokens = batch
+        for attempt in range(self.retries + 1):
+            self.budget.acquire(tokens)
+            try:
+                return self.embed_batch(texts)
+            except Exception as e:
+                if attempt == self.retries or not self.retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                print(f'embedding batch failed ({e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+
+class HashingEmbedder:
+    """an offline embedding computed on the cpu: the lowercased words and
+    word bigrams of a text, feature hashed into `dim` signed buckets and l2
+    normalized. deterministic and needs no model or network, similar texts
+    are ones that share words rather than meaning"""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def embed(self, texts: list[str], batch_size=2048) -> np.ndarray:
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = re.findall(r'\w+', text.lower())
+            features = words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+            if not features:
+                continue
+            h = np.fromiter((zlib.crc32(f.encode()) for f in features),
+                            dtype=np.uint32, count=len(features))
+            np.add.at(vecs[i], h % self.dim,
+                      np.where(h >> 31, -1, 1).astype(np.float32))
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs / np.where(norms > 0, norms, 1)
+
+
+encoding = None  # tiktoken's, when it's installed
+
+
+def count_tokens(text: str) -> int:
+    """tiktoken's count when it's installed, otherwise an overestimate"""
+    global encoding
+    if encoding is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            encoding = False
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    # english averages ~4 bytes a token
+    return len(text.encode()) // 3 + 1
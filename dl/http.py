@@ -1,7 +1,10 @@
 from fastapi import FastAPI, Form, File, UploadFile, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from .utils import data, write_data
 import dl.utils as utils
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from dataclasses import asdict
 import os
 import signal
 
@@ -42,6 +45,12 @@ async def main_menu(token: str = Query(...)):
     """)
 
 
+def doc_list() -> list:
+    """a snapshot of the docs, the ingestion worker changes data.docs"""
+    with utils.data_lock.read():
+        return list(data.docs.values())
+
+
 def file_list():
     li = "".join(
         f"""<li>
@@ -49,7 +58,7 @@ def file_list():
         <span style="font-weight: bold;color:green;">{doc.tag}</span>
         <span style="font-weight: bold;">{doc.title}</span>
     </li>"""
-        for doc in data.docs
+        for doc in doc_list()
     )
     return f"<ul>{li}</ul>"
 
@@ -73,10 +82,11 @@ async def manage_files(token: str = Query(...)):
         <button type="submit">tag</button>
     </form>
     </li>"""
-        for doc in data.docs
+        for doc in doc_list()
     )
     return html_template(token, f"""
         <h1> Manage Files</h1>
+        <a href="/jobs?token={token}">Uploads</a>
         <ul> {docs_html} </ul>
          <form id="uploadForm" action="/add-file?token={token}" method="post" enctype="multipart/form-data">
             <label for="file">Add File (Select File):</label><br>
@@ -91,20 +101,22 @@ async def add_tag(id: str = Form(...), token=Query(...), tag: str = Form(...)):
     check(token)
     global data
     print('add-tag', id, tag)
-    data.add_doc_tag(int(id), tag)
+    await run_in_threadpool(utils.tag_file, int(id), tag)
     return redirect("/files", token)
 
 
 @app.post("/delete-file")
 async def delete_file(id: int = Form(...), token=Query(...)):
     check(token)
-    utils.delete_file(id)
+    # may wait for a compaction and compact itself
+    await run_in_threadpool(utils.delete_file, id)
     return redirect("/files", token)
 
 
 @app.post("/add-file")
 async def add_file(token=Query(...), files: list[UploadFile] = File(...)):
     check(token)
+    uploads = []
     # Get the file name
     for file in files:
         file_name = file.filename
@@ -117,9 +129,41 @@ async def add_file(token=Query(...), files: list[UploadFile] = File(...)):
 
         if file_name is None or file_content is None:
             return redirect("/files", token)
+        uploads.append((file_name, file_content))
 
-        utils.add_uploaded_file(file_name, file_content)
-    return redirect("/files", token)
+    # ingested in the background, searches keep being served meanwhile
+    utils.ingest_jobs.submit([name for name, _ in uploads], uploads)
+    return redirect("/jobs", token)
+
+
+@app.get("/jobs", response_class=HTMLResponse)
+async def jobs(token: str = Query(...)):
+    check(token)
+    jobs_html = "".join(
+        f"""<li>
+        <span style="font-weight: bold;">job {job.id}: {job.state}</span>
+        <ul>{"".join(
+            f'<li>{f.name}: {f.stage} <span style="color:red;">{f.error}</span></li>'
+            for f in job.files)}</ul>
+    </li>"""
+        for job in utils.ingest_jobs.list()
+    )
+    running = any(job.state in ('queued', 'running') for job in utils.ingest_jobs.list())
+    return html_template(token, f"""
+        {'<meta http-equiv="refresh" content="2">' if running else ''}
+        <h1>Uploads</h1>
+        <a href="/files?token={token}">Manage Files</a>
+        <ul> {jobs_html} </ul>
+        """)
+
+
+@app.get("/job-status")
+async def job_status(token: str = Query(...), id: int = Query(...)):
+    check(token)
+    job = utils.ingest_jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return asdict(job)
 
 
 @app.get("/set-prompt", response_class=HTMLResponse)
@@ -207,7 +251,8 @@ async def search_results(
     doc_ids_num = parse_comma_separated_ints(doc_ids)
     doc_tags = [x.strip() for x in doc_tags.split(",") if x.strip()]
 
-    ret = utils.search_chunk2(query, doc_tags, doc_ids_num, chunk_size)
+    # embedding and faiss block, they run in the thread pool so requests overlap
+    ret = await run_in_threadpool(utils.search_chunk2, query, doc_tags, doc_ids_num, chunk_size)
     results = [f"{r.text} {r.tag} ({r.title})" for r in ret]
     results_html = "".join(
         f"<li>{result}</li>" for result in results)
@@ -217,6 +262,31 @@ async def search_results(
     """)
 
 
+class BatchQuery(BaseModel):
+    query: str
+    doc_ids: list[int] = []
+    doc_tags: list[str] = []
+
+
+class BatchSearch(BaseModel):
+    queries: list[BatchQuery]
+    chunk_size: int = 30
+
+
+@app.post("/search-batch")
+async def search_batch(body: BatchSearch, token: str = Query(...)):
+    check(token)
+    ret = await run_in_threadpool(
+        utils.search_chunk_batch,
+        [q.query for q in body.queries],
+        [(q.doc_ids, q.doc_tags) for q in body.queries],
+        body.chunk_size)
+    return [
+        [{"text": c.text, "tag": c.tag, "title": c.title} for c in chunks]
+        for chunks in ret
+    ]
+
+
 @app.get("/ask-question", response_class=HTMLResponse)
 async def ask_question(token: str = Query(...)):
     user = check(token)
@@ -225,7 +295,8 @@ async def ask_question(token: str = Query(...)):
     return html_template(token, f"""
     <h1> Ask a Question </h1>
     <div> {chat_html} </div>
-    <form id="uploadForm" action="{r("/submit-question", token)}" method="post">
+    <p id="answer" style="white-space: pre-wrap;"></p>
+    <form id="uploadForm" action="{r("/submit-question", token)}" method="post" data-stream="1">
         <label for="query">Enter your question:</label>
         <textarea id="query" name="query" rows="5" cols="40"></textarea>
 
@@ -255,14 +326,30 @@ async def submit_question(
         token: str = Query(...),
         chunk_size: int = Form(...),
         doc_ids: str = Form(...),
-        doc_tags: str = Form(...)):
+        doc_tags: str = Form(...),
+        stream: bool = Query(False)):
+    """with `stream` the answer is sent as chunked text while it's generated,
+    and goes into the chat history once it's complete"""
     doc_ids_num = parse_comma_separated_ints(doc_ids)
     doc_tags = [x.strip() for x in doc_tags.split(",") if x.strip()]
-    answer = utils.ask_question(
-        check(token), query, doc_ids_num, doc_tags, chunk_size)
-    utils.data.add_chat(token, "usr: " + query)
-    utils.data.add_chat(token, "sys: " + answer)
-    return redirect("/ask-question", token)
+    user = check(token)
+    answer = utils.ask_question_astream(
+        user, query, doc_ids_num, doc_tags, chunk_size)
+    if not stream:
+        parts = [part async for part in answer]
+        utils.data.add_chat(token, "usr: " + query)
+        utils.data.add_chat(token, "sys: " + "".join(parts))
+        return redirect("/ask-question", token)
+
+    async def answer_stream():
+        parts = []
+        async for part in answer:
+            parts.append(part)
+            yield part
+        utils.data.add_chat(token, "usr: " + query)
+        utils.data.add_chat(token, "sys: " + "".join(parts))
+    return StreamingResponse(answer_stream(), media_type="text/plain; charset=utf-8",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.on_event("shutdown")
@@ -419,11 +506,35 @@ script = """
     const form = document.getElementById('uploadForm');
     const submitButton = document.getElementById('submitButton');
 
+    const answer = document.getElementById('answer');
+
     if (form && submitButton) {
-        form.addEventListener('submit', function(event) {
+        form.addEventListener('submit', async function(event) {
             event.preventDefault();
             submitButton.disabled = true;
-            form.submit()
+            if (!form.dataset.stream || !answer || !window.ReadableStream) {
+                form.submit()
+                return
+            }
+            // show the answer as it streams in, the chat history has it after
+            answer.textContent = 'sys: '
+            try {
+                const resp = await fetch(form.action + '&stream=1', {method: 'POST', body: new FormData(form)})
+                if (!resp.ok) {
+                    throw new Error(resp.status + ' ' + resp.statusText)
+                }
+                const reader = resp.body.getReader()
+                const decoder = new TextDecoder()
+                while (true) {
+                    const {done, value} = await reader.read()
+                    if (done) break
+                    answer.textContent += decoder.decode(value, {stream: true})
+                }
+                window.location.reload()
+            } catch (e) {
+                answer.textContent += ' (failed: ' + e.message + ')'
+                submitButton.disabled = false
+            }
         });
     }
 </script>
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import queue
+import threading
+import time
+
+
+@dataclass
+class FileStatus:
+    name: str
+    stage: str = 'queued'  # queued | parsed | embedded | indexed | failed
+    error: str = ''
+
+    def fail(self, e: Exception):
+        self.stage = 'failed'
+        self.error = str(e)
+
+
+@dataclass
+class Job:
+    id: int
+    files: list[FileStatus]
+    state: str = 'queued'  # queued | running | done | failed
+    error: str = ''
+    created: float = field(default_factory=time.time)
+    finished: float = 0
+
+
+class JobQueue:
+    """jobs run one at a time, in submit order, by a background thread.
+    `run(job, payload)` does the work and moves the stages of `job.files`
+    along. the last `keep` jobs stay around for their status"""
+
+    def __init__(self, run: Callable[[Job, Any], None], keep=100):
+        self.run = run
+        self.keep = keep
+        self.jobs: OrderedDict[int, Job] = OrderedDict()
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.worker: threading.Thread = None
+
+    def submit(self, names: list[str], payload) -> Job:
+        with self.lock:
+            self.last_id += 1
+            job = Job(id=self.last_id, files=[FileStatus(name) for name in names])
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                self.jobs.popitem(last=False)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+        self.queue.put((job, payload))
+        return job
+
+    def get(self, job_id: int) -> Job:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        """newest first"""
+        with self.lock:
+            return list(reversed(self.jobs.values()))
+
+    def join(self):
+        """wait for every submitted job"""
+        self.queue.join()
+
+    def _work(self):
+        while True:
+            job, payload = self.queue.get()
+            job.state = 'running'
+            try:
+                self.run(job, payload)
+                job.state = 'done'
+            except Exception as e:
+                print(f'job {job.id} failed: {e}')
+                job.state = 'failed'
+                job.error = str(e)
+                for f in job.files:
+                    if f.stage not in ('indexed', 'failed'):
+                        f.fail(e)
+            finally:
+                job.finished = time.time()
+                self.queue.task_done()
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+import threading
+
+
+class RWLock:
+    """many readers or one writer. `with lock:` writes and is reentrant like
+    an RLock, `with lock.read():` reads. readers queue behind a waiting
+    writer so a stream of searches can't starve a change"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = None  # thread ident
+        self.depth = 0
+        self.waiting = 0  # writers
+
+    def __enter__(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.depth += 1
+                return self
+            self.waiting += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer, self.depth = me, 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            # a writer reading what it holds
+            nested = self.writer == threading.get_ident()
+            while not nested and (self.writer is not None or self.waiting):
+                self.cond.wait()
+            if not nested:
+                self.readers += 1
+        try:
+            yield
+        finally:
+            if not nested:
+                with self.cond:
+                    self.readers -= 1
+                    if self.readers == 0:
+                        self.cond.notify_all()
@@ -1,12 +1,21 @@
-from dl.utils import init, write_data, data
-from dl.http import app
-import uvicorn
-from uvicorn.config import LOGGING_CONFIG
+from dl.timing import phase, report
+import sys
 
 
-def run_server():
+def run_server(profile_startup=False):
+    # imported here so `dl --profile-startup` can time them
+    with phase('import dl.utils'):
+        from dl.utils import init, write_data, data
+    with phase('import dl.http'):
+        from dl.http import app
+    with phase('import uvicorn'):
+        import uvicorn
+        from uvicorn.config import LOGGING_CONFIG
     try:
         init()
+        if profile_startup:
+            report()
+            return
         LOGGING_CONFIG["formatters"]["default"][
             "fmt"] = "%(asctime)s %(levelprefix)s %(message)s"
         uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -17,4 +26,4 @@ def run_server():
 
 
 def main():
-    run_server()
+    run_server(profile_startup='--profile-startup' in sys.argv[1:])
@@ -0,0 +1,382 @@
+from typing import Iterable, Iterator, Tuple
+import numpy as np
+import os
+import shutil
+import sqlite3
+import threading
+
+
+class VecStore:
+    """every chunk embedding as a row of one float32 matrix, chunks refer to
+    their row by index. the rows loaded at start are a read-only `base`
+    (memory mapped from the snapshot segment, shared through the page cache), rows
+    added later go to a growable in-memory tail. `owners` is the parallel
+    row -> (doc_id, chunk_idx) column, -1 for rows not owned by a doc. rows
+    of deleted chunks stay in place (counted in `dead`) until `compact`.
+    rows are kept as `dtype` (float32 or float16) and read back as float32.
+
+    identical chunks share one row, found by content hash in `by_hash`.
+    a row owned by more than one chunk has all of its owners in `shared`"""
+
+    def __init__(self, vecs: np.ndarray = None, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+        self.base = None
+        self.nbase = 0
+        self.buf = None
+        self.n = 0
+        self.dead = 0
+        self.owner_buf = np.empty((0, 2), dtype=np.int64)
+        self.shared: dict[int, list[Tuple[int, int]]] = {}
+        self.by_hash: dict[str, int] = {}
+        if vecs is not None and vecs.ndim == 2 and len(vecs):
+            self.base = vecs
+            self.nbase = self.n = len(vecs)
+            self.owner_buf = np.full((len(vecs), 2), -1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.n
+
+    @property
+    def vecs(self) -> np.ndarray:
+        """every row, a view unless rows were added since loading or they
+        are stored as float16"""
+        return self.raw_vecs.astype(np.float32, copy=False)
+
+    @property
+    def raw_vecs(self) -> np.ndarray:
+        if self.base is None and self.buf is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        if self.buf is None:
+            return self.base
+        if self.base is None:
+            return self.buf[:self.n]
+        return np.concatenate([self.base, self.buf[:self.n - self.nbase]])
+
+    @property
+    def owners(self) -> np.ndarray:
+        return self.owner_buf[:self.n]
+
+    def get(self, rows) -> np.ndarray:
+        return self.raw(rows).astype(np.float32, copy=False)
+
+    def raw(self, rows) -> np.ndarray:
+        """`rows` as `dtype`, the base may still be another dtype when it was
+        written before a config change"""
+        if np.isscalar(rows):
+            if rows < self.nbase:
+                return self.base[rows].astype(self.dtype, copy=False)
+            return self.buf[rows - self.nbase]
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.buf is None or len(rows) == 0:
+            return self.raw_vecs[rows].astype(self.dtype, copy=False)
+        if self.base is None or rows.min() >= self.nbase:
+            return self.buf[rows - self.nbase]
+        in_base = rows < self.nbase
+        out = np.empty((len(rows), self.buf.shape[1]), dtype=self.dtype)
+        out[in_base] = self.base[rows[in_base]]
+        out[~in_base] = self.buf[rows[~in_base] - self.nbase]
+        return out
+
+    def set_owner(self, rows: np.ndarray, doc_id: int):
+        """`rows` are the chunks of `doc_id`, in order"""
+        rows = np.asarray(rows, dtype=np.int64)
+        chunk_idx = np.arange(len(rows))
+        owners = self.owner_buf[rows]
+        unowned = (owners[:, 0] == -1) | \
+            ((owners[:, 0] == doc_id) & (owners[:, 1] == chunk_idx))
+        if unowned.all() and len(np.unique(rows)) == len(rows):
+            self.owner_buf[rows, 0] = doc_id
+            self.owner_buf[rows, 1] = chunk_idx
+            return
+        for row, i in zip(rows.tolist(), chunk_idx.tolist()):
+            owner = tuple(self.owner_buf[row].tolist())
+            if owner[0] == -1:
+                self.owner_buf[row] = (doc_id, i)
+            elif owner != (doc_id, i):
+                owners = self.shared.setdefault(row, [owner])
+                if (doc_id, i) not in owners:
+                    owners.append((doc_id, i))
+
+    def find(self, key: str) -> int:
+        """the owned row stored under content hash `key`, -1 if there's none"""
+        row = self.by_hash.get(key)
+        if row is None or self.owner_buf[row, 0] == -1:
+            return -1
+        return row
+
+    def add(self, vecs: np.ndarray) -> np.ndarray:
+        """append `vecs`, returns their rows"""
+        vecs = np.asarray(vecs, dtype=self.dtype)
+        if len(vecs) == 0:
+            return np.empty(0, dtype=np.int64)
+        ntail = self.n - self.nbase
+        if self.buf is None:
+            self.buf = np.empty((max(len(vecs), 1024), vecs.shape[1]),
+                                dtype=self.dtype)
+        elif ntail + len(vecs) > len(self.buf):
+            # grow by doubling so appends are amortized O(1) per row
+            buf = np.empty((max(2 * len(self.buf), ntail + len(vecs)),
+                            self.buf.shape[1]), dtype=self.dtype)
+            buf[:ntail] = self.buf[:ntail]
+            self.buf = buf
+        if len(self.owner_buf) < self.nbase + len(self.buf):
+            owner_buf = np.full(
+                (self.nbase + len(self.buf), 2), -1, dtype=np.int64)
+            owner_buf[:self.n] = self.owner_buf[:self.n]
+            self.owner_buf = owner_buf
+        self.buf[ntail:ntail + len(vecs)] = vecs
+        rows = np.arange(self.n, self.n + len(vecs), dtype=np.int64)
+        self.n += len(vecs)
+        return rows
+
+    def replace(self, old_rows: np.ndarray, rows: np.ndarray,
+                doc_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """the chunks of `doc_id` are `rows` now instead of `old_rows`.
+        returns the rows that got their first owner and the ones that lost
+        their last"""
+        rows = np.asarray(rows, dtype=np.int64)
+        unique = np.unique(rows)
+        owned = unique[self.owner_buf[unique, 0] != -1]
+        freed = self.release(old_rows, doc_id)
+        if len(rows):
+            self.set_owner(rows, doc_id)
+        kept = freed[self.owner_buf[freed, 0] != -1]
+        self.dead -= len(kept)
+        return np.setdiff1d(unique, owned), np.setdiff1d(freed, kept)
+
+    def release(self, rows: np.ndarray, doc_id: int) -> np.ndarray:
+        """drop `doc_id` as an owner of `rows`, returns the rows left without
+        an owner, they are dead from now on"""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        in_shared = np.array([r in self.shared for r in rows.tolist()], dtype=bool)
+        freed = [rows[~in_shared & (self.owner_buf[rows, 0] == doc_id)]]
+        for row in rows[in_shared].tolist():
+            owners = [o for o in self.shared.pop(row) if o[0] != doc_id]
+            if len(owners) > 1:
+                self.shared[row] = owners
+            if owners:
+                self.owner_buf[row] = owners[0]
+            else:
+                freed.append(np.array([row], dtype=np.int64))
+        freed = np.concatenate(freed)
+        self.owner_buf[freed] = -1
+        self.dead += len(freed)
+        return freed
+
+    def compact(self, rows: np.ndarray) -> np.ndarray:
+        """keep only `rows`, in order of first appearance, in memory. returns
+        the old -> new row map (-1 for dropped rows)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        _, first = np.unique(rows, return_index=True)
+        rows = rows[np.sort(first)]
+        remap = np.full(self.n, -1, dtype=np.int64)
+        remap[rows] = np.arange(len(rows), dtype=np.int64)
+        self.buf = self.raw(rows) if len(rows) else None
+        self.owner_buf = self.owners[rows]
+        self.shared = {int(remap[r]): o for r, o in self.shared.items() if remap[r] != -1}
+        self.by_hash = {k: int(remap[r]) for k, r in self.by_hash.items() if remap[r] != -1}
+        self.base = None
+        self.nbase = 0
+        self.n = len(rows)
+        self.dead = 0
+        return remap
+
+
+class Segments:
+    """immutable numbered .npy files of vectors (as stored in VecStore), a
+    doc's vectors when it's added or every live vector when compacted. a file
+    is only in use once a MetaStore row points at it, so a crash leaves at
+    worst an orphan that `clean` removes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, seg: int, vecs: np.ndarray):
+        tmp = self._path(seg) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(vecs))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(seg))
+
+    def load(self, seg: int, mmap=False) -> np.ndarray:
+        return np.load(self._path(seg), mmap_mode='r' if mmap else None)
+
+    def adopt(self, seg: int, path: str):
+        """make the .npy file at `path` segment `seg`, without copying when
+        it's on the same filesystem"""
+        try:
+            os.link(path, self._path(seg))
+        except OSError:
+            shutil.copyfile(path, self._path(seg))
+
+    def exists(self, seg: int) -> bool:
+        return os.path.exists(self._path(seg))
+
+    def list(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.path)
+                      if name.endswith('.npy'))
+
+    def remove(self, seg: int):
+        if self.exists(seg):
+            os.remove(self._path(seg))
+
+    def clean(self, keep: set[int]):
+        """remove every segment not in `keep`"""
+        for seg in self.list():
+            if seg not in keep:
+                self.remove(seg)
+
+    def _path(self, seg: int) -> str:
+        return f'{self.path}/{seg:010d}.npy'
+
+
+class MetaStore:
+    """docs and chunks in sqlite, every change is one transaction touching
+    only its rows. a chunk's vector lives at `seg_row` of segment `seg`,
+    `hash` is the content hash it's deduplicated by (see VecStore.by_hash)"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY, title TEXT NOT NULL, tag TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS docs_tag ON docs (tag);
+            CREATE INDEX IF NOT EXISTS docs_title ON docs (title);
+            CREATE TABLE IF NOT EXISTS chunks (
+                doc_id INTEGER NOT NULL, chunk_idx INTEGER NOT NULL,
+                text TEXT NOT NULL, seg INTEGER NOT NULL, seg_row INTEGER NOT NULL,
+                hash TEXT,
+                PRIMARY KEY (doc_id, chunk_idx)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS chunks_seg ON chunks (seg);
+            CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value INTEGER);
+        ''')
+        columns = {r[1] for r in self.conn.execute('PRAGMA table_info(chunks)')}
+        if 'hash' not in columns:
+            self.conn.execute('ALTER TABLE chunks ADD COLUMN hash TEXT')
+
+    def add_doc(self, doc_id: int, title: str, tag: str,
+                chunks: list[Tuple[str, str]], seg: int) -> set[int]:
+        """(text, hash) chunks, their vectors are rows 0..len(chunks) of `seg`.
+        replaces the doc with the same id, returns the segments its chunks
+        were in"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            segs = {r[0] for r in self.conn.execute(
+                'SELECT DISTINCT seg FROM chunks WHERE doc_id = ?', (doc_id,))}
+            self._put_doc(doc_id, title, tag, [
+                (text, seg, i, key) for i, (text, key) in enumerate(chunks)])
+            return segs
+
+    def import_docs(self, seg: int, docs: Iterable[Tuple[int, str, str, list[Tuple[str, int, str]]]]):
+        """(id, title, tag, [(text, seg_row, hash)]) docs with their vectors
+        in the snapshot `seg`, in one transaction"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            for doc_id, title, tag, chunks in docs:
+                self._put_doc(doc_id, title, tag, [
+                    (text, seg, row, key) for text, row, key in chunks])
+            self._set('snapshot_seg', seg)
+
+    def delete_doc(self, doc_id: int) -> set[int]:
+        """returns the segments the doc's vectors were in"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            segs = {r[0] for r in self.conn.execute(
+                'SELECT DISTINCT seg FROM chunks WHERE doc_id = ?', (doc_id,))}
+            self.conn.execute('DELETE FROM chunks WHERE doc_id = ?', (doc_id,))
+            self.conn.execute('DELETE FROM docs WHERE id = ?', (doc_id,))
+            return segs
+
+    def set_tag(self, doc_id: int, tag: str):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE docs SET tag = ? WHERE id = ?', (tag, doc_id))
+
+    def seg_in_use(self, seg: int) -> bool:
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM chunks WHERE seg = ? LIMIT 1', (seg,)).fetchone() is not None
+
+    def segs(self) -> set[int]:
+        with self.lock:
+            return {r[0] for r in self.conn.execute('SELECT DISTINCT seg FROM chunks')}
+
+    def docs(self) -> Iterator[Tuple[int, str, str, list[Tuple[str, int, int, str]]]]:
+        """(id, title, tag, [(text, seg, seg_row, hash)]) for every doc, by id,
+        hash is None for chunks stored before it was added"""
+        with self.lock:
+            docs = self.conn.execute(
+                'SELECT id, title, tag FROM docs ORDER BY id').fetchall()
+            chunks = self.conn.execute(
+                'SELECT doc_id, text, seg, seg_row, hash FROM chunks '
+                'ORDER BY doc_id, chunk_idx').fetchall()
+        i = 0
+        for doc_id, title, tag in docs:
+            doc_chunks = []
+            while i < len(chunks) and chunks[i][0] <= doc_id:
+                if chunks[i][0] == doc_id:
+                    doc_chunks.append(chunks[i][1:])
+                i += 1
+            yield doc_id, title, tag, doc_chunks
+
+    def relocate(self, seg: int, chunks: Iterable[Tuple[int, int, int]]):
+        """move (doc_id, chunk_idx, seg_row) chunks to the snapshot `seg`"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany(
+                'UPDATE chunks SET seg = ?, seg_row = ? '
+                'WHERE doc_id = ? AND chunk_idx = ?',
+                ((seg, row, doc_id, chunk_idx) for doc_id, chunk_idx, row in chunks))
+            self._set('snapshot_seg', seg)
+
+    def snapshot_seg(self) -> int:
+        return self._get('snapshot_seg', 0)
+
+    def next_seg(self) -> int:
+        """a segment number never handed out before"""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            row = self.conn.execute(
+                "SELECT value FROM kv WHERE key = 'next_seg'").fetchone()
+            seg = row[0] if row else 1
+            self._set('next_seg', seg + 1)
+            return seg
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _put_doc(self, doc_id: int, title: str, tag: str,
+                 chunks: list[Tuple[str, int, int, str]]):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO docs (id, title, tag) VALUES (?, ?, ?)',
+            (doc_id, title, tag))
+        self.conn.execute('DELETE FROM chunks WHERE doc_id = ?', (doc_id,))
+        self.conn.executemany(
+            'INSERT INTO chunks (doc_id, chunk_idx, text, seg, seg_row, hash) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            ((doc_id, i, text, seg, row, key)
+             for i, (text, seg, row, key) in enumerate(chunks)))
+
+    def embedding_model(self) -> str:
+        """the model the stored vectors were embedded with, '' if unknown"""
+        return self._get('embedding_model', '')
+
+    def set_embedding_model(self, model: str):
+        with self.lock:
+            self._set('embedding_model', model)
+
+    def _set(self, key: str, value: int):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+
+    def _get(self, key: str, default: int) -> int:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else default
@@ -0,0 +1,50 @@
+from dl.cache import AnswerCache, EmbeddingCache
+import numpy as np
+
+
+def test_embedding_cache(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = EmbeddingCache(path, 'model', mem_size=2, disk_size=10)
+    assert cache.get('hello') is None
+    cache.put('hello', [1.0, 2.0])
+    assert np.array_equal(cache.get('hello'), [1.0, 2.0])
+
+    # evicted from memory, still on disk
+    cache.put('a', [0.0, 0.0])
+    cache.put('b', [0.0, 0.0])
+    assert len(cache.mem) == 2
+    assert np.array_equal(cache.get('hello'), [1.0, 2.0])
+    cache.close()
+
+    # persisted, and keyed by model
+    cache = EmbeddingCache(path, 'model', mem_size=2, disk_size=10)
+    assert np.array_equal(cache.get('hello'), [1.0, 2.0])
+    cache.close()
+    assert EmbeddingCache(path, 'other', disk_size=10).get('hello') is None
+
+    # disk capped
+    cache = EmbeddingCache(path, 'model', mem_size=2, disk_size=10)
+    for i in range(30):
+        cache.put(str(i), [float(i)])
+    assert cache.disk_count <= 10
+    assert np.array_equal(cache.get('29'), [29.0])
+    assert cache.get('0') is None
+
+
+def test_answer_cache():
+    cache = AnswerCache(threshold=0.99, size=3)
+    assert cache.get('k', [1.0, 0.0]) is None
+    cache.put('k', frozenset({1, 2}), [1.0, 0.0], 'answer')
+    assert cache.get('k', [2.0, 0.01]) == 'answer'
+    assert cache.get('k', [0.0, 1.0]) is None
+    assert cache.get('other', [1.0, 0.0]) is None
+
+    cache.put('k2', frozenset({3}), [1.0, 0.0], 'answer2')
+    cache.invalidate(2)
+    assert cache.get('k', [1.0, 0.0]) is None
+    assert cache.get('k2', [1.0, 0.0]) == 'answer2'
+
+    for i in range(5):
+        cache.put(f'k{i + 3}', frozenset(), [1.0, 0.0], str(i))
+    assert cache.count <= 3
+    assert cache.get('k7', [1.0, 0.0]) == '4'
@@ -0,0 +1,49 @@
+import numpy as np
+from .context import Passage, merge_overlap, mmr, pack_context, trim_history
+from .embed import count_tokens
+
+
+def test_pack_context():
+    hits = [
+        (1, 3, 'a', 'the quick brown fox jumps'),
+        (2, 0, 'b', 'something else entirely'),
+        (1, 2, 'a', 'over here the quick brown'),
+        (1, 7, 'a', 'the quick brown fox jumps!'),  # near-duplicate of the first
+        (3, 0, 'c', 'x ' * 100),  # doesn't fit
+        (3, 1, 'c', 'small'),
+    ]
+    vecs = np.array([[1, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0.01, 0], [0, 0, 1], [0, 1, 1]],
+                    dtype=np.float32)
+    budget = sum(count_tokens(hits[i][3]) for i in (0, 1, 2, 5))
+    assert pack_context(hits, vecs, budget) == [
+        Passage(1, 'a', 2, 3, 'over here the quick brown fox jumps', 0),
+        Passage(2, 'b', 0, 0, 'something else entirely', 1),
+        Passage(3, 'c', 1, 1, 'small', 5),
+    ]
+    assert pack_context([], np.empty((0, 3)), 10) == []
+
+
+def test_merge_overlap():
+    assert merge_overlap('one two three', 'two three four') == 'one two three four'
+    # too short to be the splitter's overlap
+    assert merge_overlap('a cat', 'tiger') == 'a cat tiger'
+
+
+def test_trim_history():
+    history = ['usr: ' + 'a' * 90, 'sys: ' + 'b' * 90, 'usr: c', 'sys: d']
+    assert trim_history(history, 1000) == history
+    # doesn't start at an answer
+    assert trim_history(history, count_tokens(history[1]) + 10) == ['usr: c', 'sys: d']
+    assert trim_history(history, 0) == []
+
+
+def test_mmr():
+    query = np.array([1, 0], dtype=np.float32)
+    vecs = np.array([[1, 0.1], [1, 0.11], [1, -0.5], [0, 1]], dtype=np.float32)
+    # relevance alone keeps the near-duplicate
+    assert mmr(query, vecs, 2, lambda_=1).tolist() == [0, 1]
+    assert mmr(query, vecs, 2, lambda_=0.5).tolist() == [0, 2]
+    assert mmr(query, vecs, 10, lambda_=1).tolist() == [0, 1, 2, 3]
+    # at most one per group
+    groups = np.array([7, 7, 7, 8])
+    assert mmr(query, vecs, 10, lambda_=1, groups=groups, cap=1).tolist() == [0, 3]
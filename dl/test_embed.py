@@ -0,0 +1,70 @@
+import threading
+import time
+import numpy as np
+import pytest
+from .embed import EmbeddingClient, HashingEmbedder, TokenBucket, count_tokens
+
+
+class RateLimited(Exception):
+    pass
+
+
+def test_embedding_client():
+    calls, lock = [], threading.Lock()
+    failed = set()
+
+    def embed_batch(texts):
+        with lock:
+            calls.append(list(texts))
+            # every batch is rate limited once
+            if texts[0] not in failed:
+                failed.add(texts[0])
+                raise RateLimited(texts[0])
+        time.sleep(0.01)
+        return [[float(t), 0.0] for t in texts]
+
+    texts = [str(i) for i in range(100)]
+    client = EmbeddingClient(
+        embed_batch, lambda e: isinstance(e, RateLimited),
+        concurrency=4, batch_tokens=count_tokens('0') * 10, backoff=0.001)
+    vecs = client.embed(texts)
+    assert vecs[:, 0].tolist() == list(range(100))
+    assert len(calls) == 20
+    assert all(len(batch) <= 10 for batch in calls)
+
+    assert [len(b) for b, _ in client.batches(texts, batch_size=3)][:3] == [3, 3, 3]
+
+    client = EmbeddingClient(embed_batch, lambda e: False)
+    with pytest.raises(RateLimited):
+        client.embed(['new'])
+
+    client = EmbeddingClient(
+        embed_batch, lambda e: True, retries=1, backoff=0.001)
+    client.embed_batch = lambda texts: (_ for _ in ()).throw(RateLimited())
+    with pytest.raises(RateLimited):
+        client.embed(['x'])
+
+
+def test_token_bucket():
+    bucket = TokenBucket(600)  # 10 a second
+    bucket.acquire(600)
+    start = time.monotonic()
+    bucket.acquire(5)
+    assert 0.3 < time.monotonic() - start < 2
+
+    # more than the budget goes through on a full bucket
+    start = time.monotonic()
+    TokenBucket(60).acquire(10_000)
+    assert time.monotonic() - start < 0.1
+
+
+def test_hashing_embedder():
+    embedder = HashingEmbedder(dim=64)
+    vecs = embedder.embed(['the cat sat', 'The cat sat!', 'stock prices fell', ''])
+    assert vecs.shape == (4, 64) and vecs.dtype == np.float32
+    assert np.allclose(vecs[0], vecs[1])
+    assert np.allclose(np.linalg.norm(vecs[:3], axis=1), 1)
+    assert not vecs[3].any()
+    query = embedder.embed(['a cat'])[0]
+    assert query @ vecs[0] > query @ vecs[2]
+    assert np.array_equal(HashingEmbedder(dim=64).embed(['the cat sat'])[0], vecs[0])
@@ -0,0 +1,25 @@
+from dl.jobs import JobQueue
+
+
+def test_job_queue():
+    def run(job, payload):
+        if payload == 'boom':
+            job.files[0].stage = 'indexed'
+            raise Exception('embedding failed')
+        for f in job.files:
+            f.stage = 'indexed'
+
+    jobs = JobQueue(run, keep=2)
+    first = jobs.submit(['a', 'b'], 'ok')
+    second = jobs.submit(['c', 'd'], 'boom')
+    jobs.join()
+    assert first.state == 'done'
+    assert [f.stage for f in first.files] == ['indexed', 'indexed']
+    assert second.state == 'failed'
+    assert [(f.stage, f.error) for f in second.files] == [
+        ('indexed', ''), ('failed', 'embedding failed')]
+
+    jobs.submit([], 'ok')
+    jobs.join()
+    assert [job.id for job in jobs.list()] == [3, 2]
+    assert jobs.get(1) is None
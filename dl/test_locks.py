@@ -0,0 +1,36 @@
+import threading
+import time
+from .locks import RWLock
+
+
+def test_rw_lock():
+    lock = RWLock()
+    events = []
+
+    def read(name):
+        with lock.read():
+            events.append(f'{name} in')
+            time.sleep(0.1)
+            events.append(f'{name} out')
+
+    def write():
+        with lock:
+            with lock:  # reentrant
+                with lock.read():  # and readable by the writer
+                    events.append('write')
+
+    readers = [threading.Thread(target=read, args=(n,)) for n in 'ab']
+    for t in readers:
+        t.start()
+    time.sleep(0.03)
+    writer = threading.Thread(target=write)
+    writer.start()
+    time.sleep(0.03)
+    # queued behind the waiting writer
+    late = threading.Thread(target=read, args=('c',))
+    late.start()
+    for t in readers + [writer, late]:
+        t.join()
+    # the readers overlap, the writer waits for them and the late reader for it
+    assert events[:2] == ['a in', 'b in'] or events[:2] == ['b in', 'a in']
+    assert events[4:] == ['write', 'c in', 'c out']
@@ -0,0 +1,68 @@
+from dl.store import MetaStore, Segments, VecStore
+import numpy as np
+
+
+def test_vec_store():
+    store = VecStore(np.array([[1, 1], [2, 2]], dtype=np.float32))
+    rows = store.add(np.array([[3, 3], [4, 4]], dtype=np.float32))
+    assert list(rows) == [2, 3]
+    assert np.array_equal(store.get([3, 0]), [[4, 4], [1, 1]])
+    store.set_owner(rows, 7)
+    assert store.owners.tolist() == [[-1, -1], [-1, -1], [7, 0], [7, 1]]
+
+    store.set_owner(np.array([1]), 8)
+    assert list(store.release(np.array([1, 2]), 7)) == [2]
+    remap = store.compact(np.array([3, 1, 3]))
+    assert list(remap) == [-1, 1, -1, 0]
+    assert np.array_equal(store.vecs, [[4, 4], [2, 2]])
+    assert store.owners.tolist() == [[7, 1], [8, 0]]
+
+
+def test_vec_store_shared_rows():
+    store = VecStore()
+    rows = store.add(np.ones((2, 2), dtype=np.float32))
+    store.by_hash['x'] = int(rows[0])
+    assert store.find('x') == -1  # not owned yet
+    store.set_owner(np.array([0, 1, 0]), 1)
+    store.set_owner(np.array([0]), 2)
+    assert store.find('x') == 0
+    assert store.shared == {0: [(1, 0), (1, 2), (2, 0)]}
+
+    assert len(store.release(np.array([0, 1, 0]), 1)) == 1
+    assert store.shared == {} and store.owners[0].tolist() == [2, 0]
+    assert list(store.release(np.array([0]), 2)) == [0]
+    assert store.find('x') == -1
+
+
+def test_vec_store_float16():
+    store = VecStore(np.array([[1, 1]], dtype=np.float32), dtype=np.float16)
+    store.add(np.array([[0.1, 0.2]], dtype=np.float32))
+    assert store.buf.dtype == np.float16 and store.raw([0, 1]).dtype == np.float16
+    assert store.get([0, 1]).dtype == np.float32
+    assert np.allclose(store.get(1), [0.1, 0.2], atol=1e-3)
+    store.compact(np.array([1, 0]))
+    assert store.buf.dtype == np.float16
+
+
+def test_meta_store(tmp_path):
+    segments = Segments(str(tmp_path / 'segments'))
+    store = MetaStore(str(tmp_path / 'meta.sqlite'))
+    for doc_id, texts in ((0, ['a', 'b']), (1, ['c'])):
+        seg = store.next_seg()
+        segments.write(seg, np.ones((len(texts), 3)))
+        store.add_doc(doc_id, f'doc{doc_id}', '', [(t, 'h' + t) for t in texts], seg)
+    store.set_tag(1, 't')
+    assert store.delete_doc(0) == {1}
+    assert not store.seg_in_use(1) and store.segs() == {2}
+
+    snapshot = store.next_seg()
+    assert snapshot == 3
+    store.relocate(snapshot, [(1, 0, 5)])
+    store = MetaStore(str(tmp_path / 'meta.sqlite'))
+    assert list(store.docs()) == [(1, 'doc1', 't', [('c', 3, 5, 'hc')])]
+    # never handed out again, not even after a reopen
+    assert store.snapshot_seg() == 3 and store.next_seg() == 4
+
+    # a segment nothing points at is an orphan
+    segments.clean(store.segs())
+    assert segments.list() == []
@@ -1,11 +1,30 @@
-from dl.utils import openai_call_embedding, Chunk, build_faiss2, search_vec2, Doc
+from dl.utils import openai_call_embedding, Chunk, build_faiss2, parse_docx, search_vec2, Doc
+from dl.store import MetaStore, Segments, VecStore
+import dl.utils as utils
 import faiss
+from io import BytesIO
+import json
+import subprocess
+import sys
+import threading
+import time
 import numpy as np
+import pytest
+
+
+def new_doc(id, title, tag, vecs, texts=None) -> Doc:
+    """doc with one chunk per vec, stored in utils.vec_store"""
+    rows = utils.vec_store.add(np.array(vecs, dtype=np.float32))
+    texts = texts or [str(v[0]) for v in vecs]
+    return Doc(id=id, title=title, tag=tag, chunks=[
+        Chunk(title='', tag='', text=text, vec_idx=int(row))
+        for text, row in zip(texts, rows)
+    ])
 
 
 def test_openai_call_embedding():
-    chunks = [Chunk(text="hello", vec=[], title=''),
-              Chunk(text="world", title='', vec=[])]
+    chunks = [Chunk(text="hello", title='', tag=''),
+              Chunk(text="world", title='', tag='')]
     ret = openai_call_embedding(chunks)
     print(len(ret[1].vec))
 
@@ -27,27 +46,632 @@ def test_faiss():
 
 
 def test_build_search():
-    indexes = build_faiss2([
-        Doc(
-            id=1,
-            title='doc1',
-            chunks=[
-                Chunk(title='', text='1', vec=[1, 1]),
-                Chunk(title='', text='2', vec=[2, 2]),
-                Chunk(title='', text='3', vec=[3, 3]),
-            ]
-        ),
-        Doc(
-            id=2,
-            title='doc2',
-            chunks=[
-                Chunk(title='', text='1.5', vec=[1.5, 1.5]),
-                Chunk(title='', text='2.5', vec=[2.5, 2.5]),
-                Chunk(title='', text='3.5', vec=[3.5, 3.5]),
-            ]
-        ),
-    ])
+    utils.vec_store = VecStore()
+    idx, ids_by_doc_id = build_faiss2([
+        new_doc(1, 'doc1', '', [[1, 1], [2, 2], [3, 3]]),
+        new_doc(2, 'doc2', '', [[1.5, 1.5], [2.5, 2.5], [3.5, 3.5]]),
+    ], utils.vec_store)
+    meta = utils.vec_store.owners
 
     query = np.array([[1, 1]], dtype='float32')
-    ret = search_vec2(indexes, query, 2)
-    print(ret)
+    ret = search_vec2(idx, meta, query, 2)
+    assert ret == {1: [0], 2: [0]}
+
+    # restricted to doc 2 only
+    ret = search_vec2(idx, meta, query, 2, ids_by_doc_id[2])
+    assert ret == {2: [0, 1]}
+
+
+def test_faiss_add_remove_doc():
+    utils.vec_store = VecStore()
+    utils.data.set_data([], utils.data.state)
+    utils.init_faiss()
+    doc1 = new_doc(1, 'doc1', '', [[1, 1], [2, 2]])
+    doc2 = new_doc(2, 'doc2', '', [[1.5, 1.5]])
+    utils.faiss_add_doc(doc1)
+    utils.faiss_add_doc(doc2)
+    assert utils.faiss_index.ntotal == 3
+
+    query = [1, 1]
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, query, 3)
+    assert ret == {1: [0, 1], 2: [0]}
+
+    utils.faiss_remove_doc(1)
+    assert utils.faiss_index.ntotal == 1
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, query, 3)
+    assert ret == {2: [0]}
+
+
+def test_delete_file_compacts():
+    utils.vec_store = VecStore()
+    utils.data.set_data([
+        new_doc(0, 'doc0', '', [[1, 1], [2, 2]]),
+        new_doc(1, 'doc1', '', [[3, 3]]),
+    ], utils.data.state)
+    utils.init_faiss()
+
+    utils.delete_file(0)
+    assert len(utils.vec_store) == 1
+    assert utils.data.get(1).chunks[0].vec_idx == 0
+    assert np.array_equal(utils.data.get(1).chunks[0].vec, [3, 3])
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [1, 1], 3)
+    assert ret == {1: [0]}
+
+
+
+def test_only_chunkless_docs_left():
+    utils.vec_store = VecStore()
+    utils.data.set_data([
+        new_doc(0, 'empty', '', np.empty((0, 2))),
+        new_doc(1, 'doc1', '', [[1, 1]]),
+    ], utils.data.state)
+    utils.init_faiss()
+
+    # compacts and rebuilds over no vectors at all
+    utils.delete_file(1)
+    assert utils.faiss_index is None
+    query = np.array([[1, 1]], dtype=np.float32)
+    assert utils.search_chunk_idxes(query) == [{}]
+    doc = new_doc(0, 'doc2', '', [[2, 2]])
+    utils.data.add_doc(doc)
+    utils.faiss_add_doc(doc)
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [1, 1], 3)
+    assert ret == {doc.id: [0]}
+
+def test_index_types_recall(monkeypatch):
+    keep_globals(monkeypatch)
+    rng = np.random.default_rng(1)
+    utils.vec_store = VecStore()
+    utils.data.set_data([
+        new_doc(i, f'doc{i}', '', rng.random((100, 8), dtype=np.float32))
+        for i in range(5)
+    ], utils.data.state)
+    for index_type in ['flat', 'sq8', 'fp16', 'hnsw', 'ivf', 'ivfpq']:
+        monkeypatch.setattr(utils, 'index_type', index_type)
+        utils.init_faiss()
+        recall = utils.faiss_recall(10)
+        assert recall > (0.99 if index_type == 'flat' else 0.3)
+        if index_type == 'ivfpq':
+            # exact re-scoring of the candidates wins the pq error back
+            monkeypatch.setattr(utils, 'rerank_factor', 4)
+            assert utils.faiss_recall(10) > recall
+            monkeypatch.setattr(utils, 'rerank_factor', 0)
+
+        # removed (or tombstoned) docs never come back
+        utils.faiss_remove_doc(0)
+        ret = search_vec2(utils.faiss_index, utils.vec_store.owners,
+                          utils.data.get(0).chunks[0].vec, 50,
+                          deleted=utils.faiss_deleted_ids)
+        assert 0 not in ret and len(ret) > 0
+
+
+def test_data_registry():
+    data = utils.Data(docs={}, state=utils.State(
+        users={}, prompt={}, chat_history={}))
+    for title, tag in [('a', 'x'), ('b', 'y'), ('c', 'x')]:
+        data.add_doc(Doc(id=0, title=title, tag=tag, chunks=[]))
+    assert list(data.docs) == [0, 1, 2]
+    assert data.exist('b') and not data.exist('d')
+    assert data.filter([], ['x']) == {0, 2}
+    assert data.filter([0, 1], ['x']) == {0}
+    assert data.filter([1, 5], []) == {1}
+
+    data.add_doc_tag(0, 'y')
+    assert data.filter([], ['x']) == {2}
+    assert data.filter([], ['y']) == {0, 1}
+
+    assert data.remove_doc(2)
+    assert not data.remove_doc(2)
+    assert 'x' not in data.doc_ids_by_tag
+    assert data.next_id() == 3
+
+
+def test_search_chunk_batch(monkeypatch):
+    def fake_embed(texts, batch_size=50):
+        return np.array([[float(t), float(t)] for t in texts], dtype=np.float32)
+
+    monkeypatch.setattr(utils, 'embed_texts', fake_embed)
+    utils.vec_store = VecStore()
+    utils.data.set_data([
+        new_doc(0, 'doc0', 'a', [[1, 1], [2, 2]], ['1', '2']),
+        new_doc(1, 'doc1', 'b', [[3, 3]], ['3']),
+    ], utils.data.state)
+    utils.init_faiss()
+
+    ret = utils.search_chunk_batch(
+        ['1', '3', '1'], [([], []), ([], []), ([], ['b'])], 1)
+    assert [[c.text for c in r] for r in ret] == [['1'], ['3'], ['3']]
+    assert ret[2][0].title == 'doc1'
+
+
+def use_data_dir(tmp_path, monkeypatch):
+    d = str(tmp_path)
+    monkeypatch.setattr(utils, 'data_dir', d)
+    monkeypatch.setattr(utils, 'meta_path', d + '/meta.sqlite')
+    monkeypatch.setattr(utils, 'state_path', d + '/state.json')
+    monkeypatch.setattr(utils, 'index_path', d + '/index.faiss')
+    monkeypatch.setattr(utils, 'index_meta_path', d + '/index.json')
+    monkeypatch.setattr(utils, 'meta_store', MetaStore(d + '/meta.sqlite'))
+    monkeypatch.setattr(utils, 'segments', Segments(d + '/segments'))
+
+
+def set_stored_data(docs):
+    utils.data.set_data(docs, utils.State(users={}, prompt={}, chat_history={}))
+    for doc in docs:
+        utils.store_doc(doc)
+
+
+def restart(tmp_path):
+    utils.meta_store = MetaStore(str(tmp_path / 'meta.sqlite'))
+    docs, state, utils.vec_store = utils.read_data()
+    utils.data.set_data(docs, state)
+
+
+def test_write_read_data_mmap(tmp_path, monkeypatch):
+    use_data_dir(tmp_path, monkeypatch)
+    utils.faiss_index = None
+    utils.vec_store = VecStore()
+    set_stored_data([
+        new_doc(0, 'doc0', '', [[1, 1], [2, 2]]),
+        new_doc(1, 'doc1', 't', [[3, 3]]),
+    ])
+    utils.write_data(utils.data)
+    assert len(utils.segments.list()) == 1
+
+    docs, _, store = utils.read_data()
+    assert isinstance(store.base, np.memmap)
+    assert [d.title for d in docs] == ['doc0', 'doc1']
+
+    # rows added after loading live next to the mapped ones
+    utils.vec_store = store
+    utils.data.set_data(docs, utils.data.state)
+    doc = new_doc(0, 'doc2', '', [[4, 4]])
+    utils.data.add_doc(doc)
+    utils.store_doc(doc)
+    assert np.array_equal(store.get([2, 3]), [[3, 3], [4, 4]])
+    assert np.array_equal(utils.data.get(2).chunks[0].vec, [4, 4])
+
+    # removing the mapped snapshot segment leaves the mapping intact
+    utils.write_data(utils.data)
+    assert np.array_equal(store.get(0), [1, 1])
+    docs, _, store = utils.read_data()
+    assert np.array_equal(store.vecs, [[1, 1], [2, 2], [3, 3], [4, 4]])
+
+
+
+def test_compact_beside_changes(tmp_path, monkeypatch):
+    use_data_dir(tmp_path, monkeypatch)
+    utils.vec_store = VecStore()
+    set_stored_data([
+        new_doc(0, 'doc0', '', [[1, 1], [2, 2]]),
+        new_doc(1, 'doc1', '', [[3, 3]]),
+    ])
+    utils.init_faiss()
+    write, written = utils.segments.write, []
+
+    def write_during_delete(seg, vecs):
+        if not written:
+            # data_lock isn't held while the segment is written
+            t = threading.Thread(target=utils.delete_file, args=(0,))
+            t.start()
+            t.join(5)
+            assert not t.is_alive()
+        written.append(seg)
+        write(seg, vecs)
+    monkeypatch.setattr(utils.segments, 'write', write_during_delete)
+    utils.write_data(utils.data)
+
+    # the first segment still had doc 0, it was written again without it
+    assert len(written) == 2
+    assert utils.segments.list() == [written[1]]
+    restart(tmp_path)
+    assert [d.title for d in utils.data.docs.values()] == ['doc1']
+    assert utils.load_faiss()
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [3, 3], 1)
+    assert ret == {1: [0]}
+
+def test_persisted_faiss_index(tmp_path, monkeypatch):
+    use_data_dir(tmp_path, monkeypatch)
+    utils.vec_store = VecStore()
+    set_stored_data([
+        new_doc(0, 'doc0', '', [[1, 1], [2, 2]]),
+        new_doc(1, 'doc1', '', [[3, 3]]),
+        new_doc(2, 'doc2', '', [[4, 4]]),
+    ])
+    utils.init_faiss()
+    # the written index is renumbered to the compacted rows
+    utils.delete_file(1)
+    utils.write_data(utils.data)
+
+    restart(tmp_path)
+    utils.faiss_index = None
+    assert utils.load_faiss()
+    assert utils.faiss_index.ntotal == 3
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [4, 4], 1)
+    assert ret == {2: [0]}
+
+    # stale once the index config changes
+    monkeypatch.setattr(utils, 'index_hnsw_m', 16)
+    assert not utils.load_faiss()
+
+
+def test_outgrown_faiss_index(tmp_path, monkeypatch):
+    import faiss
+    use_data_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(utils, 'index_type', 'ivf')
+    for name in ('faiss_index', 'faiss_ids_by_doc_id', 'faiss_key', 'faiss_trained'):
+        monkeypatch.setattr(utils, name, getattr(utils, name))
+    rng = np.random.default_rng(2)
+    utils.vec_store = VecStore()
+    set_stored_data([new_doc(0, 'doc0', '', rng.random((100, 8), dtype=np.float32))])
+    utils.init_faiss()
+    assert utils.faiss_key == 'Flat'
+    utils.write_data(utils.data)
+
+    # the flat fallback on disk isn't kept once there is enough to train on
+    doc = new_doc(0, 'doc1', '', rng.random((300, 8), dtype=np.float32))
+    utils.data.add_doc(doc)
+    utils.store_doc(doc)
+    restart(tmp_path)
+    assert not utils.load_faiss()
+    utils.init_faiss()
+    assert (utils.faiss_key, utils.faiss_trained) == ('IVF10,Flat', 400)
+    utils.write_data(utils.data)
+    restart(tmp_path)
+    assert utils.load_faiss()
+    assert (utils.faiss_key, utils.faiss_trained) == ('IVF10,Flat', 400)
+
+    # retrained once the library is 4x its training size
+    doc = new_doc(0, 'doc2', '', rng.random((800, 8), dtype=np.float32))
+    utils.data.add_doc(doc)
+    utils.faiss_add_doc(doc)
+    assert utils.faiss_trained == 400
+    doc = new_doc(0, 'doc3', '', rng.random((400, 8), dtype=np.float32))
+    utils.data.add_doc(doc)
+    utils.faiss_add_doc(doc)
+    assert (utils.faiss_key, utils.faiss_trained) == ('IVF41,Flat', 1600)
+    assert faiss.try_extract_index_ivf(utils.faiss_index.index).nlist == 41
+    assert utils.faiss_index.ntotal == 1600
+
+
+def test_restart_after_changes(tmp_path, uploads):
+    utils.add_uploaded_file('a', b'1 2')
+    utils.add_uploaded_file('b', b'3')
+    utils.write_data(utils.data)
+    # changes after the snapshot are their own rows and segments
+    utils.add_uploaded_file('c', b'4 5')
+    utils.delete_file(0)
+    utils.tag_file(2, 't')
+    assert len(utils.segments.list()) == 2
+
+    restart(tmp_path)
+    assert [(d.id, d.title, d.tag) for d in utils.data.docs.values()] == [
+        (1, 'b', ''), (2, 'c', 't')]
+    # the snapshot index drops doc 0 and picks up doc 2
+    assert utils.load_faiss()
+    assert utils.faiss_index.ntotal == 3
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [1, 1], 3)
+    assert ret == {1: [0], 2: [0, 1]}
+
+
+def test_migrate_json_data(tmp_path, monkeypatch):
+    use_data_dir(tmp_path, monkeypatch)
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump([{'id': 3, 'title': 'doc3', 'tag': 't', 'chunks': [
+            {'text': 'x', 'vec_idx': 1}, {'text': 'y', 'vec_idx': 0}]}], f)
+    np.save(tmp_path / 'embeddings.npy', np.array([[1, 1], [2, 2]], dtype=np.float32))
+    utils.migrate_json_data(str(tmp_path / 'meta.json'), str(tmp_path / 'embeddings.npy'))
+
+    assert not (tmp_path / 'embeddings.npy').exists()
+    docs, _, store = utils.read_data()
+    assert [(d.id, d.title, d.tag) for d in docs] == [(3, 'doc3', 't')]
+    assert np.array_equal(store.get([c.vec_idx for c in docs[0].chunks]), [[2, 2], [1, 1]])
+
+
+def test_dedupe_chunks(tmp_path, uploads):
+    utils.add_uploaded_file('a', b'1 2 1')
+    utils.add_uploaded_file('b', b'2 3')
+    assert uploads == [['1', '2'], ['3']]
+    assert utils.faiss_index.ntotal == 3
+
+    # the shared row is found for either doc, within a filter only for that doc
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [2, 2], 1,
+                      shared=utils.vec_store.shared)
+    assert ret == {0: [1], 1: [0]}
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [2, 2], 1,
+                      utils.filter_vec([1], []), shared=utils.vec_store.shared,
+                      doc_ids={1})
+    assert ret == {1: [0]}
+
+    # each upload wrote its own segment, a restart shares the rows again
+    restart(tmp_path)
+    assert len(set(utils.vec_store.by_hash.values())) == 3
+    assert utils.vec_store.dead == 2
+    utils.init_faiss()
+    utils.delete_file(0)
+    assert utils.faiss_index.ntotal == 2
+
+
+def test_reupload_diff(tmp_path, uploads):
+    utils.add_uploaded_file('a', b'1 2 3')
+    utils.tag_file(0, 't')
+    uploads.clear()
+
+    utils.add_uploaded_file('a', b'1 4 3')
+    assert uploads == [['4']]
+    assert [(d.id, d.tag) for d in utils.data.docs.values()] == [(0, 't')]
+    assert utils.faiss_index.ntotal == 3
+    ret = search_vec2(utils.faiss_index, utils.vec_store.owners, [2, 2], 3)
+    assert ret == {0: [0, 2, 1]}
+
+    restart(tmp_path)
+    assert [(d.id, d.tag, [c.text for c in d.chunks])
+            for d in utils.data.docs.values()] == [(0, 't', ['1', '4', '3'])]
+    assert len(utils.segments.list()) == 1
+
+
+def test_lazy_imports():
+    code = ('import sys, dl.utils; print(sorted('
+            'm for m in ("faiss", "docx", "openai", "langchain_text_splitters") '
+            'if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True,
+                         text=True, check=True).stdout
+    assert out.strip() == '[]'
+
+
+def docx_bytes(*paragraphs) -> bytes:
+    from docx import Document
+    doc, out = Document(), BytesIO()
+    for p in paragraphs:
+        doc.add_paragraph(p)
+    doc.save(out)
+    return out.getvalue()
+
+
+def test_add_uploaded_files(uploads, monkeypatch):
+    calls = []
+
+    def embed(texts, batch_size=50):
+        calls.append(texts)
+        return np.array([[len(t), 1] for t in texts], dtype=np.float32)
+    monkeypatch.setattr(utils, 'embed_texts', embed)
+    # real docx files, parsed in the pool
+    monkeypatch.setattr(utils, 'parse_docx', parse_docx)
+    monkeypatch.setattr(utils, 'parse_workers', 2)
+    try:
+        utils.add_uploaded_files([('a', docx_bytes('x', 'shared')),
+                                  ('b', docx_bytes('shared'))])
+    finally:
+        utils.parse_pool.shutdown()
+        utils.parse_pool = None
+    # parsed in the pool, the shared chunk embedded once
+    assert calls == [['x', 'shared']]
+    assert [(d.title, [c.text for c in d.chunks]) for d in utils.data.docs.values()] == [
+        ('a', ['x', 'shared']), ('b', ['shared'])]
+    assert utils.faiss_index.ntotal == 2
+
+
+def test_ingest_job_status(uploads, monkeypatch):
+    def parse(content):
+        if content == b'bad':
+            raise Exception('not a docx')
+        return [Chunk(text=t, title='', tag='') for t in content.decode().split()]
+    monkeypatch.setattr(utils, 'parse_docx', parse)
+    monkeypatch.setattr(utils, 'parse_workers', 1)
+    job = utils.ingest_jobs.submit(['a', 'b'], [('a', b'1 2'), ('b', b'bad')])
+    utils.ingest_jobs.join()
+    assert job.state == 'done'
+    assert [(f.name, f.stage, f.error) for f in job.files] == [
+        ('a', 'indexed', ''), ('b', 'failed', 'not a docx')]
+    assert [d.title for d in utils.data.docs.values()] == ['a']
+
+
+def test_docx_blocks():
+    from docx import Document
+    doc, out = Document(), BytesIO()
+    doc.add_paragraph('before')
+    table = doc.add_table(rows=2, cols=2)
+    for (r, c), text in zip([(0, 0), (0, 1), (1, 0), (1, 1)], ['a', 'b', 'c\nd', 'e']):
+        table.cell(r, c).text = text
+    doc.add_paragraph(' ')
+    doc.add_paragraph('after')
+    doc.save(out)
+    assert list(utils.docx_blocks(out.getvalue())) == [
+        'before', '| a | b |\n|---|---|\n| c d | e |', 'after']
+
+
+def test_add_uploaded_files_streams(uploads, monkeypatch):
+    calls, lock = [], threading.Lock()
+    running = [0, 0]  # now, max
+
+    def parse(content):
+        for t in content.decode().split():
+            yield Chunk(text=t, title='', tag='')
+
+    def embed(texts, batch_size=50):
+        with lock:
+            calls.append(texts)
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return np.array([[float(t), 1] for t in texts], dtype=np.float32)
+    monkeypatch.setattr(utils, 'parse_docx', parse)
+    monkeypatch.setattr(utils, 'embed_texts', embed)
+    monkeypatch.setattr(utils, 'stream_chunks', 2)
+    monkeypatch.setattr(utils, 'embed_batch_tokens', 2)
+    monkeypatch.setattr(utils, 'embed_concurrency', 3)
+    monkeypatch.setattr(utils, 'parse_workers', 1)
+    utils.add_uploaded_files([('a', b'1 2 1 3'), ('b', b'4 5 6 7 2')])
+    # batches of two tokens across the files, the repeated ones embedded once
+    assert sorted(calls) == [['1', '2'], ['3', '4'], ['5', '6'], ['7']]
+    assert running[1] > 1
+    a, b = utils.data.docs[0], utils.data.docs[1]
+    assert [utils.vec_store.get(c.vec_idx)[0] for c in a.chunks] == [1, 2, 1, 3]
+    assert [utils.vec_store.get(c.vec_idx)[0] for c in b.chunks] == [4, 5, 6, 7, 2]
+    assert utils.faiss_index.ntotal == 7
+
+
+def keep_globals(monkeypatch):
+    """restore the module globals init() sets once the test is over"""
+    for name, value in list(vars(utils).items()):
+        if not name.startswith('__') and not callable(value):
+            monkeypatch.setattr(utils, name, value)
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch) -> list[list[str]]:
+    """an empty library in `tmp_path` that parses every word of a file as a
+    chunk and embeds the number t as [t, t]. returns the embed calls"""
+    calls = []
+
+    def embed(texts, batch_size=50):
+        calls.append(list(texts))
+        return np.array([[float(t), float(t)] for t in texts], dtype=np.float32)
+    monkeypatch.setattr(utils, 'parse_docx', lambda content: [
+        Chunk(text=t, title='', tag='') for t in content.decode().split()])
+    monkeypatch.setattr(utils, 'embed_texts', embed)
+    use_data_dir(tmp_path, monkeypatch)
+    utils.vec_store = VecStore()
+    utils.faiss_index = None
+    utils.data.set_data([], utils.State(users={}, prompt={}, chat_history={}))
+    return calls
+
+
+def test_local_embedding_provider(tmp_path, monkeypatch):
+    keep_globals(monkeypatch)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.delenv('dl_openai_key', raising=False)
+    monkeypatch.setenv('dl_embedding_provider', 'local')
+    monkeypatch.setenv('dl_embedding_dim', '128')
+    monkeypatch.setattr(utils, 'parse_docx', lambda content: [
+        Chunk(text=t, title='', tag='') for t in content.decode().split(',')])
+    utils.vec_store = VecStore()
+    utils.faiss_index = None
+    utils.data.set_data([], utils.State(users={}, prompt={}, chat_history={}))
+    # no key needed to start, ingest and search
+    utils.init()
+    assert utils.embedding_model == 'local-hashing-128'
+    utils.add_uploaded_file('a', b'the cat sat on the mat,stock prices fell')
+    assert utils.vec_store.vecs.shape == (2, 128)
+    assert [c.text for c in utils.search_chunk_batch(['where did the cat sit'], chunk_size=1)[0]] == [
+        'the cat sat on the mat']
+    # adjacent chunks are merged into one passage
+    assert [p.text for p in utils.search_context('where did the cat sit', [], [], 2)] == [
+        'the cat sat on the mat stock prices fell']
+    with pytest.raises(Exception, match='dl_openai_key'):
+        utils.openai_client()
+
+    # the stored vectors are the local model's
+    utils.write_data(utils.data)
+    monkeypatch.setenv('dl_embedding_provider', 'openai')
+    monkeypatch.setenv('dl_openai_key', 'k')
+    with pytest.raises(Exception, match='embedded with local-hashing-128'):
+        utils.init()
+    monkeypatch.setenv('dl_embedding_provider', 'gpu')
+    with pytest.raises(Exception, match='dl_embedding_provider'):
+        utils.init()
+
+
+def test_ask_question_stream(monkeypatch):
+    from dl.cache import AnswerCache
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache(0.99))
+    monkeypatch.setattr(utils, 'embed_questions', lambda qs: np.ones((len(qs), 2), dtype=np.float32))
+    monkeypatch.setattr(utils, 'search_context', lambda *args: [])
+    monkeypatch.setattr(utils, 'openai_stream_completion', lambda user, q, chunks: iter(['an', 'swer']))
+    stream = utils.ask_question_stream('u', 'q', [], [], 5)
+    assert next(stream) == 'an'
+    # cached only once it's complete
+    assert utils.answer_cache.count == 0
+    assert list(stream) == ['swer']
+    assert list(utils.ask_question_stream('u', 'q', [], [], 5)) == ['answer']
+    assert utils.ask_question('u', 'q', [], [], 5) == 'answer'
+
+
+def test_ask_question_astream(monkeypatch):
+    import asyncio
+    import threading
+
+    async def complete(user, q, context):
+        for part in ['an', 'swer']:
+            yield part
+
+    threads = []
+
+    def search(*args):
+        threads.append(threading.current_thread())
+        return []
+    monkeypatch.setattr(utils, 'answer_cache', None)
+    monkeypatch.setattr(utils, 'search_context', search)
+    monkeypatch.setattr(utils, 'openai_astream_completion', complete)
+
+    async def ask():
+        return [part async for part in utils.ask_question_astream('u', 'q', [], [], 5)]
+    assert asyncio.run(ask()) == ['an', 'swer']
+    # searched off the event loop
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_write_faiss_without_data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'index_path', '')
+    monkeypatch.setattr(utils, 'index_meta_path', '')
+    utils.vec_store = VecStore()
+    utils.faiss_index = None
+    utils.data.set_data([new_doc(0, 'a', '', [[1, 1]])], utils.State(users={}, prompt={}, chat_history={}))
+    utils.init_faiss()
+    utils.write_faiss(np.arange(1), 1)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_delete_during_upload(uploads, monkeypatch):
+    calls = []
+
+    def embed(texts, batch_size=50):
+        calls.append(texts)
+        if len(calls) == 2:
+            # a delete that would compact lands after the upload's first
+            # rows were added, before any doc owns them
+            utils.delete_file(0)
+        return np.array([[float(t), float(t)] for t in texts], dtype=np.float32)
+    monkeypatch.setattr(utils, 'embed_texts', embed)
+    monkeypatch.setattr(utils, 'stream_chunks', 1)
+    monkeypatch.setattr(utils, 'embed_batch_tokens', 1)
+    monkeypatch.setattr(utils, 'embed_concurrency', 1)
+    set_stored_data([
+        new_doc(0, 'doc0', '', [[1, 1], [2, 2], [6, 6], [7, 7]]),
+        new_doc(1, 'doc1', '', [[3, 3]]),
+    ])
+    utils.init_faiss()
+    utils.add_uploaded_file('c', b'4 5')
+    # compacted once the upload's rows were owned
+    assert len(utils.vec_store) == 3 and utils.vec_store.dead == 0
+    assert [c.vec.tolist() for c in utils.data.get(2).chunks] == [[4, 4], [5, 5]]
+    assert utils.data.get(1).chunks[0].vec.tolist() == [3, 3]
+    assert search_vec2(utils.faiss_index, utils.vec_store.owners, [5, 5], 1) == {2: [1]}
+
+
+def test_answer_cache_key(monkeypatch):
+    from dl.cache import AnswerCache
+    calls = []
+
+    def complete(user, q, context):
+        calls.append(q)
+        return iter([f'answer {len(calls)}'])
+    monkeypatch.setattr(utils, 'answer_cache', AnswerCache(0.99))
+    monkeypatch.setattr(utils, 'embed_questions', lambda qs: np.ones((len(qs), 2), dtype=np.float32))
+    monkeypatch.setattr(utils, 'search_context', lambda *args: [])
+    monkeypatch.setattr(utils, 'openai_stream_completion', complete)
+    utils.data.set_data([new_doc(0, 'a', '', [[1, 1]])], utils.State(
+        users={'k1': 'u1', 'k2': 'u2'}, prompt={'u2': 'other'}, chat_history={}))
+    assert utils.ask_question('u1', 'q', [], [], 5) == 'answer 1'
+    utils.data.add_chat('k1', 'usr: q')
+    utils.data.add_chat('k1', 'sys: answer 1')
+    # asked again, with its own answer in the history now
+    assert utils.ask_question('u1', 'q', [], [], 5) == 'answer 1'
+    # another prompt is another answer
+    assert utils.ask_question('u2', 'q', [], [], 5) == 'answer 2'
+    # a changed doc is a new version, even without an invalidate
+    utils.data.put_doc(new_doc(0, 'a', '', [[2, 2]]))
+    assert utils.ask_question('u1', 'q', [], [], 5) == 'answer 3'
@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+import time
+
+timings: list[tuple[str, float]] = []  # (phase, seconds), in the order they ran
+
+
+@contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((name, time.perf_counter() - start))
+
+
+def report():
+    width = max((len(name) for name, _ in timings), default=0)
+    for name, seconds in timings:
+        print(f'{name:<{width}}  {seconds * 1000:8.1f} ms')
+    total = sum(seconds for _, seconds in timings)
+    print(f'{"total":<{width}}  {total * 1000:8.1f} ms')
@@ -1,23 +1,42 @@
-from dataclasses import dataclass, asdict
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from docx.oxml.table import CT_Tbl
-from docx.oxml.text.paragraph import CT_P
-from docx import Document
+# faiss, openai, python-docx and the text splitter are imported where
+# they're first used, so the server starts without them, see dl --profile-startup
+from __future__ import annotations
+from dataclasses import dataclass, asdict, field
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from io import BytesIO
-from typing import Tuple
-import faiss
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator, Tuple
+import asyncio
+import multiprocessing
 import numpy as np
 import os
-from openai import OpenAI
+import re
+import threading
+from .cache import AnswerCache, EmbeddingCache, content_hash
+from .context import Passage, mmr, pack_context, trim_history
+from .embed import EmbeddingClient, HashingEmbedder, count_tokens
+from .jobs import FileStatus, JobQueue
+from .locks import RWLock
+from .store import MetaStore, Segments, VecStore
+from .timing import phase
 import json
 
+if TYPE_CHECKING:
+    from docx.document import Document
+    from openai import AsyncOpenAI, OpenAI
+    import faiss
 
-@dataclass
+
+@dataclass(slots=True)
 class Chunk:
     tag: str
     title: str  # optional
     text: str
-    vec: list[float]
+    vec_idx: int = -1  # row in vec_store
+
+    @property
+    def vec(self) -> np.ndarray:
+        return vec_store.get(self.vec_idx)
 
 
 @dataclass
@@ -46,7 +65,13 @@ class State:
 @dataclass
 class Data:
     state: State
-    docs: list[Doc]
+    docs: dict[int, Doc]  # doc_id -> doc, in insertion order
+    doc_ids_by_tag: dict[str, set[int]] = field(default_factory=dict)
+    doc_ids_by_title: dict[str, set[int]] = field(default_factory=dict)
+    last_id: int = -1
+    # doc_id -> the change it was last added, replaced or tagged by
+    doc_versions: dict[int, int] = field(default_factory=dict)
+    version: int = 0  # changes so far, never goes back
 
     def get_user(self, key: str):
         return self.state.users.get(key, "")
@@ -73,40 +98,91 @@ class Data:
         self.set_prompt(key, default_prompt)
 
     def get(self, doc_id: int) -> Doc:
-        for d in self.docs:
-            if d.id == doc_id:
-                return d
-        return Doc(0, "", "", [])
+        return self.docs.get(doc_id) or Doc(0, "", "", [])
 
     def next_id(self) -> int:
-        if len(self.docs) == 0:
-            return 0
-        max_id = max(doc.id for doc in self.docs)
-        return max_id + 1
+        return self.last_id + 1
 
     def exist(self, name: str) -> bool:
-        for doc in self.docs:
-            if doc.title == name:
-                return True
-        return False
+        return bool(self.doc_ids_by_title.get(name))
+
+    def filter(self, doc_ids: list[int], doc_tags: list[str]) -> set[int]:
+        """ids of the docs matching any of `doc_tags` and any of `doc_ids`,
+        an empty list doesn't filter"""
+        if doc_tags:
+            ret = set()
+            for tag in doc_tags:
+                ret |= self.doc_ids_by_tag.get(tag, set())
+            if doc_ids:
+                ret &= set(doc_ids)
+            return ret
+        if doc_ids:
+            return {i for i in doc_ids if i in self.docs}
+        return set(self.docs)
 
     def add_doc_tag(self, id: int, tag: str):
-        for i, doc in enumerate(self.docs):
-            if doc.id == id:
-                self.docs[i].tag = tag
-                return
+        doc = self.docs.get(id)
+        if doc is None:
+            return
+        self._unindex(self.doc_ids_by_tag, doc.tag, id)
+        doc.tag = tag
+        self.doc_ids_by_tag.setdefault(tag, set()).add(id)
+        self._bump(id)
 
     def add_doc(self, doc: Doc) -> int:
         doc.id = self.next_id()
-        self.docs.append(doc)
-        # write to local
+        self.put_doc(doc)
         return doc.id
 
+    def put_doc(self, doc: Doc):
+        """add `doc` under its own id"""
+        self._index(doc)
+
+    def remove_doc(self, doc_id: int) -> bool:
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return False
+        self._unindex(self.doc_ids_by_tag, doc.tag, doc_id)
+        self._unindex(self.doc_ids_by_title, doc.title, doc_id)
+        self.doc_versions.pop(doc_id, None)
+        self.version += 1
+        return True
+
     def set_data(self, docs: list[Doc], state: State):
         gray('setting data for docs')
-        self.docs = docs
+        self.docs = {}
+        self.doc_ids_by_tag = {}
+        self.doc_ids_by_title = {}
+        self.doc_versions = {}
+        self.last_id = -1
+        for doc in docs:
+            self._index(doc)
         self.state = state
 
+    def _index(self, doc: Doc):
+        self.docs[doc.id] = doc
+        self.doc_ids_by_tag.setdefault(doc.tag, set()).add(doc.id)
+        self.doc_ids_by_title.setdefault(doc.title, set()).add(doc.id)
+        self.last_id = max(self.last_id, doc.id)
+        self._bump(doc.id)
+
+    def versions(self, doc_ids: Iterable[int]) -> list[Tuple[int, int]]:
+        """sorted (doc_id, version) pairs, they change whenever a doc does"""
+        return sorted((i, self.doc_versions.get(i, 0)) for i in doc_ids)
+
+    def _bump(self, doc_id: int):
+        self.version += 1
+        self.doc_versions[doc_id] = self.version
+
+    @staticmethod
+    def _unindex(index: dict[str, set[int]], key: str, doc_id: int):
+        ids = index.get(key)
+        if ids is None:
+            return
+        ids.discard(doc_id)
+        if not ids:
+            del index[key]
+
 
 default_prompt = """
 you're a helpful assistant that help user do RAG on their uploaded documents,
@@ -117,109 +193,477 @@ chunk structure: text (from: document_name)
 """
 
 
-data = Data(docs=[], state=State(
+data = Data(docs={}, state=State(
     users={}, prompt={}, chat_history={}))
-client: OpenAI = None
+client: OpenAI = None  # see openai_client
+async_client: AsyncOpenAI = None  # see openai_async_client
+openai_connections = 20  # pooled keep-alive connections of async_client
+openai_key = ''
 prompt = {}
 faiss_vec_idx = None
-faiss_vec_by_doc_id = None
 faiss_meta_idx = []
+vec_store = VecStore()
+faiss_index = None  # one IndexIDMap2 over the chunks of every doc, id = vec_idx
+faiss_ids_by_doc_id = {}  # doc_id -> faiss ids of its chunks
+faiss_deleted_ids = np.empty(0, dtype=np.int64)  # tombstones, hnsw only
+index_type = 'flat'  # flat | sq8 | fp16 | hnsw | ivf | ivfpq
+index_nlist = 1024
+index_nprobe = 16
+index_ef_search = 64
+index_hnsw_m = 32
+index_pq_m = 16
+index_retrain_growth = 4  # see faiss_stale
+faiss_key = ''  # index_factory key of faiss_index
+faiss_trained = 0  # vectors faiss_index was trained on, 0 when it needs none
+recall_k = 0
+rerank_factor = 0  # re-score n * factor candidates exactly, 0 is off
+vec_dtype = 'float32'  # float32 | float16, of vec_store and the segments
 data_dir = ''
 state_path = ''
 meta_path = ''
-embedding_path = ''
+index_path = ''
+index_meta_path = ''
+meta_store: MetaStore = None  # docs and chunks, the source of truth
+segments: Segments = None  # chunk vectors, see MetaStore
+compact_segments = 64
+compact_retries = 3  # see write_data
+compacting = False
+data_lock = RWLock()  # `with` for doc changes and compaction, .read() for searches
+ingesting = 0  # uploads whose new rows aren't in data.docs yet, see ingest_rows
 top_n_chunk = 30
+context_tokens = 6000  # of retrieved chunks in a completion, see pack_context
+history_tokens = 2000  # of chat history in a completion
+mmr_k = 0  # chunks kept by mmr re-ranking before packing, 0 is off
+mmr_lambda = 0.7  # relevance vs. diversity, 1 is relevance only
+doc_cap = 0  # chunks kept per doc before packing, 0 is no cap
+parse_workers = os.cpu_count() or 1
+parse_pool: ProcessPoolExecutor = None  # see parse_files
+embed_concurrency = 4
+stream_chunks = 512  # chunks parsed before they're handed to ChunkEmbedder
+embed_tpm = 1_000_000  # tokens per minute budget of the embedding api
+embed_batch_tokens = 50_000
+embed_retries = 6
+embedding_provider = 'openai'  # openai | local
+embedding_dim = 384  # of the local provider
+embedder: EmbeddingClient | HashingEmbedder = None  # see get_embedder
+openai_embedding_model = "text-embedding-3-small"
+embedding_model = openai_embedding_model  # keys the caches and chunk hashes
+completion_model = "gpt-4o-2024-08-06"
+embedding_cache: EmbeddingCache = None
+answer_cache: AnswerCache = None
 
 
 def init():
-    global data, data_dir, meta_path, embedding_path, state_path, client, prompt, top_n_chunk
+    global data, data_dir, meta_path, state_path, client, openai_key, prompt, top_n_chunk
+    global context_tokens, history_tokens, async_client, openai_connections
+    global mmr_k, mmr_lambda, doc_cap
+    global index_path, index_meta_path, meta_store, segments, compact_segments
+    global index_type, index_nlist, index_nprobe, index_ef_search, index_hnsw_m, index_pq_m, recall_k
+    global rerank_factor, vec_dtype, parse_workers, embed_concurrency
+    global embed_tpm, embed_batch_tokens, embed_retries, embedder
+    global embedding_cache, answer_cache
+    global embedding_provider, embedding_dim, embedding_model
+    embedding_provider = os.getenv("dl_embedding_provider", "openai")
+    if embedding_provider not in ('openai', 'local'):
+        raise Exception("dl_embedding_provider needs to be one of openai, local")
+    embedding_dim = int(os.getenv("dl_embedding_dim", 384))
+    if embedding_dim <= 0:
+        raise Exception("dl_embedding_dim needs to be positive")
+    embedding_model = (openai_embedding_model if embedding_provider == 'openai'
+                       else f'local-hashing-{embedding_dim}')
+    # with the local provider it's only needed for answers, see openai_client
     openai_key = os.getenv("dl_openai_key", "")
-    if openai_key == "":
+    if openai_key == "" and embedding_provider == 'openai':
         raise Exception("dl_openai_key needs to be set")
 
     top_n_chunk = int(os.getenv("dl_top_n_chunk", 30))
+    context_tokens = int(os.getenv("dl_context_tokens", 6000))
+    history_tokens = int(os.getenv("dl_history_tokens", 2000))
+    mmr_k = int(os.getenv("dl_mmr_k", 0))
+    mmr_lambda = float(os.getenv("dl_mmr_lambda", 0.7))
+    doc_cap = int(os.getenv("dl_doc_cap", 0))
+
+    index_type = os.getenv("dl_index_type", "flat")
+    if index_type not in ('flat', 'sq8', 'fp16', 'hnsw', 'ivf', 'ivfpq'):
+        raise Exception("dl_index_type needs to be one of flat, sq8, fp16, hnsw, ivf, ivfpq")
+    index_nlist = int(os.getenv("dl_nlist", 1024))
+    index_nprobe = int(os.getenv("dl_nprobe", 16))
+    index_ef_search = int(os.getenv("dl_ef_search", 64))
+    index_hnsw_m = int(os.getenv("dl_hnsw_m", 32))
+    index_pq_m = int(os.getenv("dl_pq_m", 16))
+    recall_k = int(os.getenv("dl_recall_k", 0))
+    rerank_factor = int(os.getenv("dl_rerank", 0))
+    vec_dtype = os.getenv("dl_vec_dtype", "float32")
+    if vec_dtype not in ('float32', 'float16'):
+        raise Exception("dl_vec_dtype needs to be one of float32, float16")
+
+    parse_workers = int(os.getenv("dl_parse_workers", os.cpu_count() or 1))
+    embed_concurrency = int(os.getenv("dl_embed_concurrency", 4))
+    embed_tpm = int(os.getenv("dl_embed_tpm", 1_000_000))
+    embed_batch_tokens = int(os.getenv("dl_embed_batch_tokens", 50_000))
+    embed_retries = int(os.getenv("dl_embed_retries", 6))
+    embedder = None
 
     prompt = os.getenv("dl_prompt", default_prompt)
     if prompt == "":
         raise Exception("dl_prompt needs to be set")
 
-    client = OpenAI(api_key=openai_key)
+    client = None
+    async_client = None
+    openai_connections = int(os.getenv("dl_openai_connections", 20))
     data_dir = f'{os.path.expanduser("~")}/.dl/data'
-    meta_path = data_dir + "/meta.json"
-    embedding_path = data_dir + "/embeddings.npy"
+    meta_path = data_dir + "/meta.sqlite"
+    index_path = data_dir + "/index.faiss"
+    index_meta_path = data_dir + "/index.json"
     state_path = data_dir + "/state.json"
-    doc_list, state = read_data()
-    data.set_data(doc_list, state)
+    os.makedirs(data_dir, exist_ok=True)
+    with phase('open caches'):
+        embedding_cache = EmbeddingCache(
+            data_dir + "/embedding_cache.sqlite", embedding_model,
+            disk_size=int(os.getenv("dl_embedding_cache_size", 100_000)))
+        answer_threshold = float(os.getenv("dl_answer_cache_threshold", 0))
+        if answer_threshold > 0:
+            answer_cache = AnswerCache(answer_threshold)
+    compact_segments = int(os.getenv("dl_compact_segments", 64))
+    with phase('open meta store'):
+        meta_store = MetaStore(meta_path)
+        segments = Segments(data_dir + "/segments")
+        migrate_json_data(data_dir + "/meta.json", data_dir + "/embeddings.npy")
+
+    global vec_store
+    with phase('read data'):
+        doc_list, state, vec_store = read_data()
+        data.set_data(doc_list, state)
+    check_embedding_model()
     gray(f'init docs, exist {len(data.docs)} files')
-    if len(data.docs) == 0:
-        return
-    init_faiss()
+    if len(data.docs) > 0:
+        # the only phase that imports faiss
+        with phase('load faiss index'):
+            if not load_faiss():
+                init_faiss()
 
 
 def init_faiss():
     gray('init faiss')
     # global faiss_vec_idx
     # global faiss_meta_idx
-    global faiss_vec_by_doc_id
+    global faiss_index, faiss_ids_by_doc_id, faiss_deleted_ids
+    faiss_deleted_ids = np.empty(0, dtype=np.int64)
     if len(data.docs) == 0:
+        faiss_index, faiss_ids_by_doc_id = None, {}
         return
     # faiss_vec_idx, faiss_meta_idx = build_faiss(data.docs)
-    faiss_vec_by_doc_id = build_faiss2(data.docs)
-
-
-text_splitter = RecursiveCharacterTextSplitter(
-    # Set a really small chunk size, just to show.
-    chunk_size=400,
-    chunk_overlap=50,
-    length_function=len,
-    is_separator_regex=False,
-)
-
-
-def docx_to_str(doc: Document) -> str:
-    output = []
-
-    tblcnt = 0
-    for element in doc.element.body:
-        if isinstance(element, CT_P):  # Paragraph element
-            paragraph = element.text.strip()
-            if paragraph:  # Exclude empty paragraphs
-                output.append(paragraph)
-        elif isinstance(element, CT_Tbl):  # Table element
-            if tblcnt < len(doc.tables):
-                table = doc.tables[tblcnt]
-                tblcnt += 1
-                markdown_table = []
-                for row_idx, row in enumerate(table.rows):
-                    cells = [cell.text.strip().replace('\n', ' ')
-                             for cell in row.cells]
-                    markdown_table.append('| ' + ' | '.join(cells) + ' |')
-
-                    # Add a header separator after the first row
-                    if row_idx == 0:
-                        markdown_table.append(
-                            '|' + '|'.join(['---' for _ in cells]) + '|')
-
-                output.append('\n'.join(markdown_table))
-
-    # Combine all extracted content into a single string
-    return output
-
+    faiss_index, faiss_ids_by_doc_id = build_faiss2(
+        data.docs.values(), vec_store)
+    if (index_type != 'flat' or vec_dtype != 'float32') and recall_k > 0:
+        gray(f'faiss {index_type} ({vec_dtype} vectors, rerank x{rerank_factor}) '
+             f'recall@{recall_k}: {faiss_recall(recall_k):.3f}, '
+             f'vectors {vec_store.raw_vecs.nbytes >> 20}MB')
+
+
+def faiss_factory_key(n: int, dimension: int) -> str:
+    """index_factory key of the configured `index_type` for `n` vectors. ivf
+    and sq8 fall back to flat below 256 vectors, nlist and the pq bits grow
+    with `n`"""
+    nlist = max(1, min(index_nlist, n // 39))
+    key = 'Flat'
+    if index_type == 'hnsw':
+        key = f'HNSW{index_hnsw_m}'
+    elif index_type == 'fp16':
+        key = 'SQfp16'
+    elif index_type == 'sq8' and n >= 256:
+        # per dimension min/max, trained like the ivf centroids
+        key = 'SQ8'
+    elif index_type == 'ivf' and n >= 256:
+        key = f'IVF{nlist},Flat'
+    elif index_type == 'ivfpq' and n >= 256:
+        # pq sub-quantizers need to divide the dimension, and each of their
+        # 2^nbits centroids wants ~39 training points
+        m = max(x for x in range(1, index_pq_m + 1) if dimension % x == 0)
+        nbits = min(8, int(np.log2(n / 39)))
+        key = f'IVF{nlist},PQ{m}x{nbits}'
+    return key
+
+
+def new_faiss_index(embeddings_np: np.ndarray) -> faiss.IndexIDMap2:
+    """empty index of the configured `index_type`, trained on `embeddings_np`
+    when the type needs it. its key and training size become `faiss_key` and
+    `faiss_trained`, see faiss_stale"""
+    import faiss
+    global faiss_key, faiss_trained
+    n, dimension = embeddings_np.shape
+    key = faiss_factory_key(n, dimension)
+    idx = faiss.index_factory(dimension, key)
+    faiss_key, faiss_trained = key, 0
+    if not idx.is_trained:
+        idx.train(embeddings_np)
+        faiss_trained = n
+    gray(f'faiss index type: {key}')
+    return faiss.IndexIDMap2(idx)
+
+
+def faiss_stale(n: int) -> bool:
+    """the live index wants a rebuild now that it holds `n` vectors: it is the
+    flat fallback of a type that can be trained by now, or it was trained on
+    fewer than 1/`index_retrain_growth` of them and its lists, codebooks or
+    ranges were fitted to a small sample"""
+    if faiss_index is None:
+        return False
+    wanted = faiss_factory_key(n, faiss_index.d)
+    if re.sub(r'\d+', '', wanted) != re.sub(r'\d+', '', faiss_key):
+        return True
+    return faiss_trained > 0 and n >= faiss_trained * index_retrain_growth
+
+
+def faiss_search_params(sel) -> faiss.SearchParameters:
+    import faiss
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=index_ef_search)
+    if index_type in ('ivf', 'ivfpq') and faiss_index is not None and \
+            faiss.try_extract_index_ivf(faiss_index.index) is not None:
+        return faiss.SearchParametersIVF(sel=sel, nprobe=index_nprobe)
+    return faiss.SearchParameters(sel=sel)
+
+
+def faiss_search(idx: faiss.IndexIDMap2, queries: np.ndarray, n: int, sel=None) -> np.ndarray:
+    """faiss ids (vec_store rows) of the top `n` of every query. with
+    `rerank_factor` the index returns n * factor candidates, ordered again by
+    their exact distance to the vec_store rows"""
+    if rerank_factor <= 1:
+        _, indices = idx.search(queries, n, params=faiss_search_params(sel))
+        return indices
+    _, indices = idx.search(
+        queries, n * rerank_factor, params=faiss_search_params(sel))
+    valid = indices != -1
+    vecs = vec_store.get(np.where(valid, indices, 0).ravel()).reshape(
+        indices.shape[0], indices.shape[1], -1)
+    dists = ((vecs - queries[:, None, :]) ** 2).sum(axis=2)
+    dists[~valid] = np.inf
+    order = np.argsort(dists, axis=1, kind='stable')[:, :n]
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def faiss_recall(k=10, n_queries=100) -> float:
+    """recall@k of the live index (and rerank) against an exact flat search
+    over the same vectors, queried with a sample of the stored chunks"""
+    import faiss
+    if not faiss_ids_by_doc_id:
+        return 1.0
+    ids = np.unique(np.concatenate(list(faiss_ids_by_doc_id.values())))
+    if len(ids) == 0:
+        return 1.0
+    embeddings_np = vec_store.get(ids)
+    exact = faiss.IndexIDMap2(faiss.IndexFlatL2(embeddings_np.shape[1]))
+    exact.add_with_ids(embeddings_np, ids)
+
+    rng = np.random.default_rng(0)
+    queries = embeddings_np[rng.choice(
+        len(ids), min(n_queries, len(ids)), replace=False)]
+    _, expected = exact.search(queries, k)
+    sel = None
+    if len(faiss_deleted_ids):
+        sel = faiss.IDSelectorNot(faiss.IDSelectorBatch(faiss_deleted_ids))
+    got = faiss_search(faiss_index, queries, k, sel)
+
+    hits, total = 0, 0
+    for e, g in zip(expected, got):
+        e = set(e[e != -1])
+        hits += len(e & set(g[g != -1]))
+        total += len(e)
+    return hits / total if total else 1.0
+
+
+def faiss_add_doc(doc: Doc):
+    """index the chunks of `doc`, in place of the ones it had before"""
+    faiss_add_docs([doc])
+
+
+def faiss_add_docs(docs: list[Doc]):
+    """faiss_add_doc for many docs with one index update"""
+    faiss_set_docs([(doc.id, np.array([c.vec_idx for c in doc.chunks], dtype=np.int64))
+                    for doc in docs])
+
+
+def faiss_remove_doc(doc_id: int):
+    faiss_set_docs([(doc_id, np.empty(0, dtype=np.int64))])
+
+
+def faiss_set_docs(docs: list[Tuple[int, np.ndarray]]):
+    """make each `ids` the chunks of `doc_id` in the live index, for every
+    (doc_id, ids) of `docs` in order. only rows that gain their first owner
+    are added and only rows that lose their last are removed, unchanged and
+    shared chunks are left alone. hnsw can't remove vectors, so they are
+    tombstoned and left out of every search until they make up a quarter of
+    the index, then the index is rebuilt"""
+    import faiss
+    global faiss_index, faiss_deleted_ids
+    added, removed = [], []
+    for doc_id, ids in docs:
+        old_ids = faiss_ids_by_doc_id.pop(doc_id, np.empty(0, dtype=np.int64))
+        doc_added, doc_removed = vec_store.replace(old_ids, ids, doc_id)
+        if len(ids):
+            faiss_ids_by_doc_id[doc_id] = ids
+        added.append(doc_added)
+        removed.append(doc_removed)
+    added, removed = np.concatenate(added), np.concatenate(removed)
+    # a row freed by one doc and owned by a later one (or the other way
+    # around) stays as it was
+    both = np.intersect1d(added, removed)
+    added, removed = np.setdiff1d(added, both), np.setdiff1d(removed, both)
+    if len(added) and len(faiss_deleted_ids):
+        # tombstoned rows owned again are still in the graph
+        revived = np.isin(faiss_deleted_ids, added)
+        added = np.setdiff1d(added, faiss_deleted_ids[revived])
+        faiss_deleted_ids = faiss_deleted_ids[~revived]
+    if len(added):
+        embeddings_np = vec_store.get(added)
+        if faiss_index is None:
+            faiss_index = new_faiss_index(embeddings_np)
+        faiss_index.add_with_ids(embeddings_np, added)
+    gray(f'faiss {len(docs)} docs: added {len(added)}, removed {len(removed)} chunks')
+    if len(added) and faiss_stale(faiss_index.ntotal - len(faiss_deleted_ids)):
+        gray(f'faiss {faiss_key} outgrown, rebuilding')
+        init_faiss()
+        return
+    if len(removed) == 0 or faiss_index is None:
+        return
+    if isinstance(faiss.downcast_index(faiss_index.index), faiss.IndexHNSW):
+        faiss_deleted_ids = np.concatenate([faiss_deleted_ids, removed])
+        if len(faiss_deleted_ids) * 4 > faiss_index.ntotal:
+            init_faiss()
+        return
+    faiss_index.remove_ids(removed)
 
-def parse_docx(file: bytes) -> list[Chunk]:
-    # Partition the PDF into structured elements
-    doc_str = BytesIO(file)
 
-    text = docx_to_str(Document(doc_str))
+text_splitter = None  # see get_text_splitter
 
-    chunks = [
-        chunk.page_content for chunk in text_splitter.create_documents(text)
-    ]
 
-    ret = []
-    for chunk in chunks:
-        ret.append(Chunk(text=chunk, vec=[], title='', tag=''))
-    return ret
+def get_text_splitter():
+    global text_splitter
+    if text_splitter is None:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        text_splitter = RecursiveCharacterTextSplitter(
+            # Set a really small chunk size, just to show.
+            chunk_size=400,
+            chunk_overlap=50,
+            length_function=len,
+            is_separator_regex=False,
+        )
+    return text_splitter
+
+
+def docx_blocks(file: bytes) -> Iterator[str]:
+    """the paragraphs and markdown tables of a docx file, in order.
+    the document xml is parsed incrementally and every block is dropped
+    once it's yielded, so memory doesn't grow with the document"""
+    from docx.oxml.ns import qn
+    from docx.oxml.parser import element_class_lookup
+    from docx.table import Table
+    from lxml import etree
+    import zipfile
+
+    with zipfile.ZipFile(BytesIO(file)) as z:
+        parser = etree.XMLPullParser(events=('start', 'end'), resolve_entities=False)
+        parser.set_element_class_lookup(element_class_lookup)
+        depth = 0
+        with z.open(docx_main_part(z)) as f:
+            while block := f.read(1 << 16):
+                parser.feed(block)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        depth += 1
+                        continue
+                    depth -= 1
+                    if depth != 2:  # document > body > block
+                        continue
+                    if element.tag == qn('w:p'):  # Paragraph element
+                        paragraph = element.text.strip()
+                        if paragraph:  # Exclude empty paragraphs
+                            yield paragraph
+                    elif element.tag == qn('w:tbl'):  # Table element
+                        yield table_to_markdown(Table(element, None))
+                    element.getparent().remove(element)
+        parser.close()
+
+
+def docx_main_part(z) -> str:
+    """name of the main document part, usually word/document.xml"""
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+    from lxml import etree
+    try:
+        rels = etree.fromstring(z.read('_rels/.rels'))
+    except KeyError:
+        return 'word/document.xml'
+    for rel in rels:
+        if rel.get('Type') == RT.OFFICE_DOCUMENT:
+            return rel.get('Target').lstrip('/')
+    return 'word/document.xml'
+
+
+def table_to_markdown(table) -> str:
+    markdown_table = []
+    for row_idx, row in enumerate(table.rows):
+        cells = [cell.text.strip().replace('\n', ' ')
+                 for cell in row.cells]
+        markdown_table.append('| ' + ' | '.join(cells) + ' |')
+
+        # Add a header separator after the first row
+        if row_idx == 0:
+            markdown_table.append(
+                '|' + '|'.join(['---' for _ in cells]) + '|')
+    return '\n'.join(markdown_table)
+
+
+def parse_docx(file: bytes) -> Iterator[Chunk]:
+    for text in docx_chunks(file):
+        yield Chunk(text=text, title='', tag='')
+
+
+def docx_chunks(file: bytes) -> Iterator[str]:
+    """the chunk texts of a docx file, split block by block as it's read"""
+    splitter = get_text_splitter()
+    for block in docx_blocks(file):
+        yield from splitter.split_text(block)
+
+
+def parse_docx_texts(file: bytes) -> list[str]:
+    """docx_chunks as a list of plain strings, so it can run in parse_pool"""
+    return list(docx_chunks(file))
+
+
+def parse_files(contents: list[bytes]) -> Iterator[tuple[int, list[Chunk] | Exception]]:
+    """parse_docx for every file, in parse_pool when there's more than one.
+    yields (file index, chunks) as they're parsed, in `stream_chunks` pieces
+    when parsing in process and a file at a time from the pool. a file that
+    fails to parse yields its exception and nothing after it"""
+    global parse_pool
+    if len(contents) <= 1 or parse_workers <= 1:
+        for i, content in enumerate(contents):
+            batch = []
+            try:
+                for chunk in parse_docx(content):
+                    batch.append(chunk)
+                    if len(batch) >= stream_chunks:
+                        yield i, batch
+                        batch = []
+            except Exception as e:
+                yield i, e
+                continue
+            if batch:
+                yield i, batch
+        return
+    if parse_pool is None:
+        # spawned, not forked: the server has threads and open sqlite files
+        parse_pool = ProcessPoolExecutor(
+            parse_workers, mp_context=multiprocessing.get_context('spawn'))
+    futures = [parse_pool.submit(parse_docx_texts, content) for content in contents]
+    for i, future in enumerate(futures):
+        try:
+            texts = future.result()
+        except Exception as e:
+            yield i, e
+            continue
+        yield i, [Chunk(text=text, title='', tag='') for text in texts]
 
 
 def read_as_bytes(file_path: str) -> bytes:
@@ -232,168 +676,587 @@ def read_as_bytes(file_path: str) -> bytes:
         raise Exception(f"An error occurred while reading the file: {e}")
 
 
-def openai_call_completion(username, question: str, chunks: list[Chunk]) -> str:
+def openai_call_completion(username, question: str, context: list[Passage]) -> str:
+    return "".join(openai_stream_completion(username, question, context))
+
+
+def openai_stream_completion(username, question: str, context: list[Passage]) -> Iterator[str]:
+    """the answer, piece by piece as the completion api streams it"""
+    if len(context) == 0:
+        yield "no data"
+        return
+    gray('calling completion api')
+    stream = openai_client().chat.completions.create(
+        model=completion_model,
+        messages=completion_messages(username, question, context),
+        stream=True)
+    for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+
+
+async def openai_astream_completion(username, question: str, context: list[Passage]) -> AsyncIterator[str]:
+    """openai_stream_completion on async_client, for the event loop"""
+    if len(context) == 0:
+        yield "no data"
+        return
+    gray('calling completion api')
+    stream = await openai_async_client().chat.completions.create(
+        model=completion_model,
+        messages=completion_messages(username, question, context),
+        stream=True)
+    async for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+
+
+def completion_messages(username, question: str, context: list[Passage]) -> list[dict]:
+    """only the chat history that fits in history_tokens is sent"""
     global data
-    if len(chunks) == 0:
-        return "no data"
     retrieved_context = "\n".join(
-        [f'{chunk.text} ({chunk.title})' for chunk in chunks])
-    gray('calling completion api')
+        [f'{passage.text} ({passage.title})' for passage in context])
     msgs = [
         {"role": "user", "content": msg[4:]} if msg.startswith('usr:') else {
             "role": "assistant", "content": msg[4:]}
-        for msg in data.state.chat_history.get(username, [])
+        for msg in trim_history(data.state.chat_history.get(username, []), history_tokens)
     ]
     msgs.insert(
         0, {
             "role": "system",
             "content": data.state.prompt.get(username, default_prompt) +
             " (never format response, just plain text)"})
-    msgs = msgs + [{"role": "user",
-                   "content": f"Context:\n{retrieved_context}\nQuestion:{question}",
+    return msgs + [{"role": "user",
+                    "content": f"Context:\n{retrieved_context}\nQuestion:{question}",
                     }]
-    ret = client.chat.completions.create(
-        model="gpt-4o-2024-08-06",
-        messages=msgs)
-    return ret.choices[0].message.content
-
 
-def openai_call_embedding(chunks: list[Chunk], batch_size=50) -> list[Chunk]:
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i:i + batch_size]
-        texts = [chunk.text for chunk in batch]
 
-        # Call the OpenAI Embedding API for the batch
-        response = client.embeddings.create(
-            input=texts,
-            model="text-embedding-3-small"
-        )
+def openai_client() -> OpenAI:
+    global client
+    if client is None:
+        if openai_key == "":
+            raise Exception("dl_openai_key needs to be set")
+        from openai import OpenAI
+        client = OpenAI(api_key=openai_key)
+    return client
+
+
+def openai_async_client() -> AsyncOpenAI:
+    """one client for the server's lifetime, its connections are pooled
+    and kept alive between questions"""
+    global async_client
+    if async_client is None:
+        if openai_key == "":
+            raise Exception("dl_openai_key needs to be set")
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        async_client = AsyncOpenAI(api_key=openai_key, http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=openai_connections,
+                                max_keepalive_connections=openai_connections,
+                                keepalive_expiry=60)))
+    return async_client
+
+
+def embed_texts(texts: list[str], batch_size=2048) -> np.ndarray:
+    """embeddings of `texts` in order, by the configured provider"""
+    return get_embedder().embed(texts, batch_size)
+
+
+def get_embedder() -> EmbeddingClient | HashingEmbedder:
+    """the embedding provider, anything with
+    embed(texts, batch_size) -> float32 array of one row per text"""
+    global embedder
+    if embedder is None:
+        if embedding_provider == 'local':
+            embedder = HashingEmbedder(embedding_dim)
+        else:
+            embedder = EmbeddingClient(
+                openai_embed_batch, openai_retryable,
+                concurrency=embed_concurrency, tpm=embed_tpm,
+                batch_tokens=embed_batch_tokens, retries=embed_retries)
+    return embedder
+
+
+def check_embedding_model():
+    """stored vectors can't be searched with another model's, refuse to
+    start on a provider change unless there are no docs"""
+    stored = meta_store.embedding_model()
+    # stores from before the model was recorded were embedded with openai
+    if data.docs and (stored or openai_embedding_model) != embedding_model:
+        raise Exception(
+            f"docs were embedded with {stored or openai_embedding_model}, not "
+            f"{embedding_model}, delete them or change dl_embedding_provider back")
+    if stored != embedding_model:
+        meta_store.set_embedding_model(embedding_model)
+
+
+def openai_embed_batch(batch: list[str]) -> list[list[float]]:
+    # EmbeddingClient retries, with its own backoff
+    response = openai_client().with_options(max_retries=0).embeddings.create(
+        input=batch,
+        model=embedding_model
+    )
+    return [embedding_data.embedding for embedding_data in response.data]
+
+
+def openai_retryable(e: Exception) -> bool:
+    """rate limits, server errors and dropped connections"""
+    import openai
+    if isinstance(e, openai.APIConnectionError):  # timeouts too
+        return True
+    return isinstance(e, openai.APIStatusError) and (
+        e.status_code == 429 or e.status_code >= 500)
+
+
+def openai_call_embedding(chunks: list[Chunk], batch_size=2048) -> list[Chunk]:
+    """embed `chunks` into new vec_store rows, see ChunkEmbedder"""
+    with ChunkEmbedder(batch_size) as embedding:
+        embedding.put(chunks)
+        embedding.finish()
+    return chunks
 
-        # Assign embeddings to the corresponding Chunk objects
-        for chunk, embedding_data in zip(batch, response.data):
-            chunk.vec = embedding_data.embedding
 
-    return chunks
+class ChunkEmbedder:
+    """embeds the chunks streamed in with put() into new vec_store rows. the
+    distinct new texts are batched up to embed_batch_tokens (and `batch_size`
+    texts) and embedded in a pool, up to embed_concurrency batches in flight.
+    a chunk identical to one already stored, or put before, shares its row
+    and isn't embedded again. finish() waits for every batch"""
+
+    def __init__(self, batch_size=2048):
+        self.batch_size = batch_size
+        self.concurrency = max(1, embed_concurrency)
+        self.pool = ThreadPoolExecutor(self.concurrency)
+        self.futures = []
+        self.lock = threading.Lock()  # rows and waiting, batches finish in the pool
+        self.rows: dict[str, int] = {}  # content hash -> row embedded by this
+        self.waiting: dict[str, list[Chunk]] = {}  # content hash -> chunks of a batch
+        self.batch: list[Tuple[str, str]] = []  # (content hash, text) not sent yet
+        self.tokens = 0
+        self.count = 0
+
+    def __enter__(self) -> ChunkEmbedder:
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(cancel_futures=exc[0] is not None)
+
+    def put(self, chunks: Iterable[Chunk]):
+        for chunk in chunks:
+            self.count += 1
+            key = chunk_hash(chunk.text)
+            with self.lock:
+                row = self.rows.get(key, -1)
+                if row < 0 and key in self.waiting:
+                    self.waiting[key].append(chunk)
+                    continue
+                if row < 0:
+                    row = vec_store.find(key)
+                if row >= 0:
+                    chunk.vec_idx = row
+                    continue
+                self.waiting[key] = [chunk]
+            self.batch.append((key, chunk.text))
+            self.tokens += count_tokens(chunk.text)
+            if self.tokens >= embed_batch_tokens or len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        # a bounded queue, parsing waits when embedding falls behind
+        pending = [f for f in self.futures if not f.done()]
+        if len(pending) >= 2 * self.concurrency:
+            wait(pending, return_when=FIRST_COMPLETED)
+        self.futures.append(self.pool.submit(self._embed, self.batch))
+        self.batch, self.tokens = [], 0
+
+    def finish(self):
+        """wait for every batch, raises the first one that failed"""
+        self.flush()
+        for future in self.futures:
+            future.result()
+        gray(f'embedded {len(self.rows)} of {self.count} chunks')
+
+    def _embed(self, batch: list[Tuple[str, str]]):
+        vecs = embed_texts([text for _, text in batch], self.batch_size)
+        with data_lock, self.lock:
+            rows = vec_store.add(vecs)
+            # Assign rows to the corresponding Chunk objects
+            for (key, _), row in zip(batch, rows):
+                vec_store.by_hash[key] = self.rows[key] = int(row)
+                for chunk in self.waiting.pop(key):
+                    chunk.vec_idx = int(row)
+
+
+def chunk_hash(text: str) -> str:
+    return content_hash(embedding_model, text)
 
 
 def write_data(data: Data):
-    global data_dir, meta_path, embedding_path
+    """write the state file and compact every segment into one. the live
+    vectors are copied under data_lock.read() and written out as the new
+    segment without the lock, which is only taken to switch to it. docs
+    changing meanwhile throw the segment away, after `compact_retries` of
+    those the whole write holds data_lock"""
+    for _ in range(compact_retries):
+        with data_lock.read():
+            version = data.version
+            write_state(data)
+            if meta_store is None:
+                return
+            rows, locations = snapshot_rows(data)
+            vecs = vec_store.raw(rows)
+        seg = meta_store.next_seg()
+        segments.write(seg, vecs)
+        with data_lock:
+            if data.version == version:
+                commit_snapshot(seg, rows, locations)
+                return
+        gray('docs changed while compacting, retrying')
+        segments.remove(seg)
+    with data_lock:
+        rows, locations = snapshot_rows(data)
+        seg = meta_store.next_seg()
+        segments.write(seg, vec_store.raw(rows))
+        commit_snapshot(seg, rows, locations)
+
+
+def write_state(data: Data):
+    global data_dir
     print('writing to disk...')
     os.makedirs(data_dir, exist_ok=True)
-    metadata = []
-    embeddings = []
-    for idx, doc in enumerate(data.docs):
-        meta = doc.to_meta()
-        for chunk_idx, chunk in enumerate(doc.chunks):
-            embeddings.append(chunk.vec)
-            meta['chunks'].append(
-                {'text': chunk.text, 'vec_idx': len(embeddings) - 1})
-        metadata.append(meta)
-    with open(state_path, 'w') as f:
+    with open_atomic(state_path, 'w') as f:
         json.dump(asdict(data.state), f)
-    # write meta file
-    with open(meta_path, 'w') as f:
-        json.dump(metadata, f)
-    # write embedding
-    embeddings_array = np.array(embeddings, dtype=np.float32)
-    np.save(embedding_path, embeddings_array)
 
 
-def read_data() -> Tuple[list[Doc], State]:
+def snapshot_rows(data: Data) -> Tuple[np.ndarray, list[Tuple[int, int, int]]]:
+    """the live rows, in doc order, that become the new snapshot segment,
+    and the (doc_id, chunk_idx, segment row) of every chunk"""
+    seg_rows = {}  # vec_idx -> row in the segment, shared rows are written once
+    locations = []
+    for doc in data.docs.values():
+        for chunk_idx, chunk in enumerate(doc.chunks):
+            row = seg_rows.setdefault(chunk.vec_idx, len(seg_rows))
+            locations.append((doc.id, chunk_idx, row))
+    return np.array(list(seg_rows), dtype=np.int64), locations
+
+
+def commit_snapshot(seg: int, rows: np.ndarray, locations: list[Tuple[int, int, int]]):
+    """make the written `seg` the snapshot, the caller holds data_lock"""
+    # the commit point, a crash before it leaves an orphan segment
+    meta_store.relocate(seg, locations)
+    segments.clean(meta_store.segs() | {seg})
+    write_faiss(rows, seg)
+
+
+def store_doc(doc: Doc):
+    """durably add (or replace) `doc`: its vectors as a new segment, then
+    its rows"""
+    if meta_store is None:
+        return
+    seg = meta_store.next_seg()
+    segments.write(seg, vec_store.raw([c.vec_idx for c in doc.chunks]))
+    remove_segments(meta_store.add_doc(
+        doc.id, doc.title, doc.tag,
+        [(c.text, chunk_hash(c.text)) for c in doc.chunks], seg))
+
+
+def unstore_doc(doc_id: int):
+    if meta_store is None:
+        return
+    remove_segments(meta_store.delete_doc(doc_id))
+
+
+def remove_segments(segs: set[int]):
+    """remove the segments of `segs` nothing points at anymore"""
+    snapshot = meta_store.snapshot_seg()
+    for seg in segs:
+        if seg != snapshot and not meta_store.seg_in_use(seg):
+            segments.remove(seg)
+
+
+def maybe_compact():
+    """compact in the background once there are many small segments"""
+    global compacting
+    if segments is None or compacting:
+        return
+    if len(segments.list()) > compact_segments:
+        compacting = True
+        threading.Thread(target=compact, daemon=True).start()
+
+
+def compact():
+    global compacting
+    try:
+        write_data(data)
+    finally:
+        compacting = False
+
+
+def migrate_json_data(json_meta_path: str, embedding_path: str):
+    """import a library from the meta.json and embeddings.npy files of older
+    versions, the embeddings file becomes the snapshot segment"""
+    if not os.path.exists(json_meta_path) or meta_store.snapshot_seg() or meta_store.segs():
+        return
+    gray(f'migrating {json_meta_path} to {meta_path}')
+    with open(json_meta_path, 'r') as f:
+        metas = json.load(f)
+    seg = meta_store.next_seg()
+    if os.path.exists(embedding_path):
+        segments.adopt(seg, embedding_path)
+    meta_store.import_docs(seg, (
+        (meta['id'], meta['title'], meta.get('tag', ''),
+         [(chunk['text'], chunk['vec_idx'], chunk_hash(chunk['text']))
+          for chunk in meta['chunks']])
+        for meta in metas))
+    os.replace(json_meta_path, json_meta_path + '.bak')
+    if os.path.exists(embedding_path):
+        os.remove(embedding_path)
+
+
+@contextmanager
+def open_atomic(path: str, mode: str):
+    """write to a temp file renamed over `path` on success. the old file
+    stays intact for readers that still have it mapped (see read_data)"""
+    tmp = f'{path}.tmp'
+    with open(tmp, mode) as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_data() -> Tuple[list[Doc], State, VecStore]:
+    """the docs in meta_store with their vectors: the snapshot segment
+    memory mapped as the vec_store base, the segments added since in the
+    tail"""
     gray('reading data from disk...')
-    global meta_path, embedding_path, state_path
-    metas = []
+    global state_path
     state = State(prompt={}, chat_history={}, users={})
     try:
-        if os.path.exists(meta_path):
-            with open(meta_path, 'r') as f:
-                metas = json.load(f)
         if os.path.exists(state_path):
             with open(state_path, 'r') as f:
                 tmp = json.load(f)
                 state = State(**tmp)
-        embeddings = np.load(embedding_path)
 
         for k, v in state.users.items():
             if state.prompt.get(k, "") == "":
                 state.prompt[k] = default_prompt
-
-        docs_list = []
-        for meta in metas:
-            chunks = []
-            for chunk in meta['chunks']:
-                vec = embeddings[chunk['vec_idx']].tolist()
-                chunks.append(
-                    Chunk(text=chunk['text'], vec=vec, title='', tag=''))
-            docs_list.append(Doc(
-                id=meta["id"],
-                title=meta["title"],
-                chunks=chunks,
-                tag=meta.get('tag', ''),
-            ))
-        return docs_list, state
     except Exception as e:
         print(f'error loading data from disk...: {e}')
-        return [], state
+    if meta_store is None:
+        return [], state, VecStore(dtype=vec_dtype)
+
+    snapshot = meta_store.snapshot_seg()
+    in_use = meta_store.segs()
+    # mapped, not read: rows are paged in on use and the page cache is
+    # shared by every process serving the same library
+    store = VecStore(segments.load(snapshot, mmap=True)
+                     if snapshot in in_use else None, dtype=vec_dtype)
+    offsets = {snapshot: 0}
+    for seg in sorted(in_use - {snapshot}):
+        offsets[seg] = len(store)
+        store.add(segments.load(seg))
+
+    docs_list = []
+    for doc_id, title, tag, chunks in meta_store.docs():
+        doc = Doc(id=doc_id, title=title, chunks=[], tag=tag)
+        for text, seg, row, key in chunks:
+            # identical chunks share the row of the first one
+            key = key or chunk_hash(text)
+            vec_idx = store.by_hash.setdefault(key, offsets[seg] + row)
+            doc.chunks.append(Chunk(text=text, vec_idx=vec_idx, title='', tag=''))
+        docs_list.append(doc)
+    store.dead = len(store) - len(set(store.by_hash.values()))
+    # segments a crash left behind
+    segments.clean(in_use | {snapshot})
+    gray(f'{len(in_use - {snapshot})} segments since the snapshot')
+    return docs_list, state, store
 
 # meta is (doc_idx, chunk_idx)
 
 
 def search_vec2(
-        idx: dict[int, faiss.IndexFlatL2],
+        idx: faiss.IndexIDMap2,
+        meta: np.ndarray,
         query: list[float],
-        n=50) -> dict[str, list[int]]:
-    gray('search_vec2')
+        n=50,
+        ids: np.ndarray = None,
+        deleted: np.ndarray = None,
+        shared: dict[int, list[Tuple[int, int]]] = None,
+        doc_ids: set[int] = None) -> dict[int, list[int]]:
+    """single top-n search over the global index, see search_vec_batch"""
+    query = np.array(query, dtype=np.float32).reshape(1, -1)
+    return search_vec_batch(idx, meta, query, n, ids, deleted, shared, doc_ids)[0]
+
+
+def search_vec_batch(
+        idx: faiss.IndexIDMap2,
+        meta: np.ndarray,
+        queries: np.ndarray,
+        n=50,
+        ids: np.ndarray = None,
+        deleted: np.ndarray = None,
+        shared: dict[int, list[Tuple[int, int]]] = None,
+        doc_ids: set[int] = None) -> list[dict[int, list[int]]]:
+    """one top-n matrix search for every row of `queries`, restricted to
+    `ids` (faiss ids, see filter_vec) when given and skipping the `deleted`
+    tombstones. `meta` maps faiss ids to (doc_id, chunk_idx), see
+    VecStore.owners, and `shared` the ids of deduplicated chunks to all
+    their owners, of which only the ones in `doc_ids` are kept when given.
+    returns per query doc_id -> chunk_idx list in ascending distance order"""
+    import faiss
+    gray(f'search_vec_batch: {len(queries)} queries')
     if idx is None:
         raise Exception('faiss index not initialize')
-    query = np.array(query, dtype=np.float32).reshape(1, -1)
+    queries = np.asarray(queries, dtype=np.float32)
+
+    sel = None
+    if ids is not None:
+        if len(ids) == 0:
+            return [{} for _ in queries]
+        sel = faiss.IDSelectorBatch(ids)
+    elif deleted is not None and len(deleted):
+        sel = faiss.IDSelectorNot(faiss.IDSelectorBatch(deleted))
+    indices = faiss_search(idx, queries, n, sel)
+
+    rets = []
+    for row in indices:
+        ret = {}
+        for i in row:
+            if i == -1:
+                continue
+            if shared and i in shared:
+                for doc_id, chunk_idx in shared[i]:
+                    if doc_ids is None or doc_id in doc_ids:
+                        ret.setdefault(doc_id, []).append(chunk_idx)
+                continue
+            doc_id, chunk_idx = meta[i]
+            ret.setdefault(int(doc_id), []).append(int(chunk_idx))
+        rets.append(ret)
+
+    return rets
 
-    tmp = {}
-    for doc_id, index in idx.items():
-        dist, indices = index.search(query, n)
-        tmp[doc_id] = list(zip(indices[0], dist[0]))
 
-    tmp_list = []
-    # find the combined top n
-    for doc_id, t in tmp.items():
-        for idx, dist in t:
-            tmp_list.append((doc_id, idx, dist))
+def build_faiss2(
+    docs: Iterable[Doc],
+    store: VecStore,
+) -> Tuple[faiss.IndexIDMap2 | None, dict[int, np.ndarray]]:
+    """index the chunks of `docs` under their vec_idx, recording the owners
+    in `store`. no index when none of them has a chunk"""
+    ids_by_doc_id = faiss_doc_ids(docs, store)
+    ids = np.unique(np.concatenate(list(ids_by_doc_id.values())))
+    if len(ids) == 0:
+        return None, ids_by_doc_id
+    if np.array_equal(ids, np.arange(len(store))):
+        # every row in order, as after read_data: no copy
+        embeddings_np = store.vecs
+    else:
+        embeddings_np = store.get(ids)
+    idx = new_faiss_index(embeddings_np)
+    idx.add_with_ids(embeddings_np, ids)
 
-    sorted_data = sorted(tmp_list, key=lambda x: x[2])
+    gray('faiss index built')
+    return idx, ids_by_doc_id
 
-    ret = {}
-    for doc_id, i, dist in sorted_data[:n]:
-        if doc_id not in ret:
-            ret[doc_id] = []
-        ret[doc_id].append(i)
 
-    return ret
+def faiss_doc_ids(docs: Iterable[Doc], store: VecStore) -> dict[int, np.ndarray]:
+    """doc_id -> faiss ids of its chunks, recording the owners in `store`"""
+    ids_by_doc_id = {}
+    for doc in docs:
+        ids = np.array([c.vec_idx for c in doc.chunks], dtype=np.int64)
+        store.set_owner(ids, doc.id)
+        ids_by_doc_id[doc.id] = ids
+    return ids_by_doc_id
 
 
-def build_faiss2(
-    docs: list[Doc]
-) -> dict[int, faiss.IndexFlatL2]:
-    indexes = {}
-    for doc in docs:
-        embeddings = []
-        for chunk_idx, chunk in enumerate(doc.chunks):
-            embeddings.append(chunk.vec)
-            # meta.append((doc.id, chunk_idx))
-        # embeddings for one docs
-        embeddings_np = np.array(embeddings, dtype=np.float32)
-        dimension = embeddings_np.shape[1]
-        idx = faiss.IndexFlatL2(dimension)
-        idx.add(embeddings_np)
-        indexes[doc.id] = idx
+INDEX_VERSION = 2
 
-    gray('faiss index built')
-    return indexes
+
+def index_checksum(seg: int) -> str:
+    """ties a persisted index to the snapshot segment it was built from,
+    and to the index config. segments are never rewritten so the number is
+    enough"""
+    config = f'{INDEX_VERSION} {index_type} {index_nlist} {index_hnsw_m} {index_pq_m}'
+    return content_hash(config, str(seg))
+
+
+def write_faiss(rows: np.ndarray, seg: int):
+    """persist the live index next to the snapshot segment `seg` just
+    written by write_data, where row i of the segment was row `rows[i]`"""
+    import faiss
+    global index_path, index_meta_path
+    if not index_path:
+        # no data dir, init() wasn't called
+        return
+    if faiss_index is None or len(faiss_deleted_ids):
+        # tombstoned vectors can't be dropped from the file, rebuild instead
+        for path in (index_path, index_meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    idx = faiss_index
+    if not np.array_equal(rows, np.arange(len(rows))):
+        # ids are vec_idx, renumbered by write_data
+        remap = np.full(len(vec_store), -1, dtype=np.int64)
+        remap[rows] = np.arange(len(rows), dtype=np.int64)
+        idx = faiss.clone_index(faiss_index)
+        ids = faiss.vector_to_array(idx.id_map)
+        faiss.copy_array_to_vector(remap[ids], idx.id_map)
+        idx.construct_rev_map()
+    faiss.write_index(idx, f'{index_path}.tmp')
+    os.replace(f'{index_path}.tmp', index_path)
+    with open_atomic(index_meta_path, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'checksum': index_checksum(seg),
+                   'key': faiss_key, 'trained': faiss_trained}, f)
+
+
+def load_faiss() -> bool:
+    """load the index persisted by write_faiss, False when it's missing or
+    stale and needs a rebuild. it covers the snapshot segment, so the chunks
+    deleted since are removed from it and the ones added since are added.
+    an index the library has outgrown (see faiss_stale) is rebuilt too"""
+    import faiss
+    global faiss_index, faiss_ids_by_doc_id, faiss_deleted_ids, faiss_key, faiss_trained
+    try:
+        if not os.path.exists(index_path) or not os.path.exists(index_meta_path):
+            return False
+        with open(index_meta_path, 'r') as f:
+            index_meta = json.load(f)
+        if index_meta.get('version') != INDEX_VERSION or \
+                index_meta.get('checksum') != index_checksum(meta_store.snapshot_seg()):
+            gray('faiss index on disk is stale')
+            return False
+        faiss_index = faiss.read_index(index_path)
+        faiss_key, faiss_trained = index_meta['key'], index_meta['trained']
+    except Exception as e:
+        print(f'error loading faiss index from disk...: {e}')
+        return False
+    faiss_ids_by_doc_id = faiss_doc_ids(data.docs.values(), vec_store)
+    faiss_deleted_ids = np.empty(0, dtype=np.int64)
+    owners = vec_store.owners[:, 0]
+    deleted = np.flatnonzero(owners[:vec_store.nbase] == -1)
+    if len(deleted):
+        if isinstance(faiss.downcast_index(faiss_index.index), faiss.IndexHNSW):
+            faiss_deleted_ids = deleted.astype(np.int64)
+        else:
+            faiss_index.remove_ids(deleted.astype(np.int64))
+    added = vec_store.nbase + np.flatnonzero(owners[vec_store.nbase:] != -1)
+    if len(added):
+        faiss_index.add_with_ids(vec_store.get(added), added.astype(np.int64))
+    if faiss_stale(faiss_index.ntotal - len(faiss_deleted_ids)):
+        gray(f'faiss {faiss_key} on disk outgrown by {faiss_index.ntotal} vectors')
+        return False
+    gray(f'faiss index loaded, {faiss_index.ntotal} vectors, '
+         f'{len(deleted)} deleted and {len(added)} added since')
+    return True
 
 
 # meta is (doc_idx, chunk_idx)
 def build_faiss(
     docs: list[Doc]
 ) -> Tuple[faiss.IndexFlatL2, list[Tuple[int, int]]]:
+    import faiss
     embeddings = []
     meta = []
     for doc in docs:
@@ -428,22 +1291,114 @@ def search_vec(
 
 
 def search_chunk2(question: str, doc_tags: list[str], doc_ids: list[int], chunk_size: int) -> list[Chunk]:
+    return search_chunk_batch([question], [(doc_ids, doc_tags)], chunk_size)[0]
+
+
+def search_chunk_batch(
+        questions: list[str],
+        filters: list[Tuple[list[int], list[str]]] = None,
+        chunk_size=30) -> list[list[Chunk]]:
+    """retrieve the chunks of many questions, optionally each with its own
+    (doc_ids, doc_tags) filter. the questions are embedded in one request and
+    searched with one matrix search per distinct filter"""
+    if not questions:
+        return []
+    question_vecs = embed_questions(questions)
+    with data_lock.read():
+        results = [retrieved_chunks(idx) for idx in search_chunk_idxes(
+            question_vecs, filters, chunk_size)]
+    gray(f'{sum(len(r) for r in results)} chunks retrived')
+    return results
+
+
+def search_chunk_idxes(
+        question_vecs: np.ndarray,
+        filters: list[Tuple[list[int], list[str]]] = None,
+        chunk_size=30) -> list[dict[int, list[int]]]:
+    """doc_id -> chunk_idx list of every question, see search_chunk_batch.
+    the caller holds data_lock.read(), the idxes are only valid under it"""
     global data
-    ret = openai_call_embedding(
-        chunks=[Chunk(text=question, vec=[], title='', tag='')])
-    question_vec = ret[0].vec
-    gray(f"question embedding generated: {len(question_vec)}")
-    idxes = search_vec2(filter_vec(doc_ids, doc_tags),
-                        question_vec, chunk_size)
+    if filters is None:
+        filters = [([], [])] * len(question_vecs)
+
+    # queries sharing a filter share one selector and one search
+    groups = {}
+    for i, (doc_ids, doc_tags) in enumerate(filters):
+        key = (tuple(sorted(set(doc_ids))), tuple(sorted(set(doc_tags))))
+        groups.setdefault(key, []).append(i)
+
+    results = [{} for _ in question_vecs]
+    if faiss_index is None:
+        # docs without a single chunk
+        return results
+    for (doc_ids, doc_tags), rows in groups.items():
+        ids = filter_vec(list(doc_ids), list(doc_tags))
+        allowed = None
+        if ids is not None and vec_store.shared:
+            allowed = data.filter(list(doc_ids), list(doc_tags))
+        idxes = search_vec_batch(
+            faiss_index, vec_store.owners, question_vecs[rows], chunk_size,
+            ids, faiss_deleted_ids, vec_store.shared, allowed)
+        for row, idx in zip(rows, idxes):
+            results[row] = idx
+    return results
+
+
+def search_context(question: str, doc_tags: list[str], doc_ids: list[int], chunk_size: int) -> list[Passage]:
+    """the chunks retrieved for `question` packed into context_tokens,
+    closest first by exact distance or re-ranked by mmr / doc_cap"""
+    question_vec = embed_questions([question])[0]
+    # the index, the rows and the docs stay put until the vecs are copied out
+    with data_lock.read():
+        idx = search_chunk_idxes(question_vec[None], [(doc_ids, doc_tags)], chunk_size)[0]
+        hits, rows = [], []
+        for doc_id, chunk_idxes in idx.items():
+            doc = data.get(doc_id)
+            for chunk_idx in chunk_idxes:
+                chunk = doc.chunks[chunk_idx]
+                hits.append((doc_id, chunk_idx, doc.title, chunk.text))
+                rows.append(chunk.vec_idx)
+        if not hits:
+            return []
+        vecs = vec_store.get(np.array(rows, dtype=np.int64))
+    if mmr_k > 0 or doc_cap > 0:
+        # fewer, more diverse chunks, without mmr the cap alone in distance order
+        order = mmr(question_vec, vecs, mmr_k or len(hits), mmr_lambda if mmr_k > 0 else 1.0,
+                    np.array([hit[0] for hit in hits]), doc_cap)
+    else:
+        order = np.argsort(((vecs - question_vec) ** 2).sum(axis=1), kind='stable')
+    context = pack_context([hits[i] for i in order], vecs[order], context_tokens)
+    gray(f'{len(hits)} chunks retrived, packed into {len(context)} passages')
+    return context
+
+
+def embed_questions(questions: list[str]) -> np.ndarray:
+    """embeddings of `questions`, only the ones missing from the
+    embedding cache are embedded, in a single request"""
+    vecs = [None] * len(questions)
+    if embedding_cache is not None:
+        vecs = [embedding_cache.get(q) for q in questions]
+    missing = [i for i, vec in enumerate(vecs) if vec is None]
+    if missing:
+        ret = embed_texts([questions[i] for i in missing], batch_size=2048)
+        for i, vec in zip(missing, ret):
+            vecs[i] = vec
+            if embedding_cache is not None:
+                embedding_cache.put(questions[i], vec)
+    gray(f"question embeddings: {len(questions)}, "
+         f"{len(questions) - len(missing)} cached")
+    return np.array(vecs, dtype=np.float32)
+
+
+def retrieved_chunks(idxes: dict[int, list[int]]) -> list[Chunk]:
     retrived = []
     for doc_id, idx in idxes.items():
         doc = data.get(doc_id)
         for chunk_idx in idx:
-            chunk = data.get(doc_id).chunks[chunk_idx]
+            chunk = doc.chunks[chunk_idx]
             chunk.title = doc.title
             chunk.tag = doc.tag
             retrived.append(chunk)
-    gray(f'{len(retrived)} chunks retrived')
     return retrived
 
 
@@ -451,10 +1406,7 @@ def search_chunk(question: str, chunk_size: int) -> list[Chunk]:
     global data
     global faiss_meta_idx
     global faiss_vec_idx
-    ret = openai_call_embedding(
-        chunks=[Chunk(text=question, vec=[], title='', tag='')])
-    question_vec = ret[0].vec
-    gray(f"question embedding generated: {len(question_vec)}")
+    question_vec = embed_questions([question])[0]
     idxes = search_vec(faiss_vec_idx, faiss_meta_idx, question_vec, chunk_size)
     retrived = []
     for (doc_idx, chunk_idx, _) in idxes:
@@ -479,29 +1431,128 @@ def green(msg: str):
 
 
 def add_uploaded_file(name: str, content: bytes):
-    chunks = parse_docx(content)
+    add_uploaded_files([(name, content)])
 
-    # _name = name.removesuffix(".docx")
-    for chunk in chunks:
-        chunk.text = chunk.text  # add title into the chunk
 
-    # Call OpenAI API to get vector embeddings
-    chunks = openai_call_embedding(chunks)
+def add_uploaded_files(files: list[Tuple[str, bytes]], status: list[FileStatus] = None):
+    """parse every (name, content) file in parallel, embed the chunks as
+    they're parsed and update the index once. with `status` (one per file)
+    the stage of every file is updated as it goes and files that fail to
+    parse are skipped, without it the first parse error is raised"""
+    with ingest_rows():
+        _add_uploaded_files(files, status)
 
-    # Create a new document and add to the Docs instance
-    doc = Doc(id=0, title=name, chunks=chunks, tag='')
-    _ = data.add_doc(doc)
-    init_faiss()
+
+@contextmanager
+def ingest_rows():
+    """hold off compact_vecs while an upload has rows in vec_store that no
+    doc owns yet, it would drop them and renumber the rest under it"""
+    global ingesting
+    with data_lock:
+        ingesting += 1
+    try:
+        yield
+    finally:
+        with data_lock:
+            ingesting -= 1
+            if not ingesting and vec_store.dead * 2 > len(vec_store):
+                compact_vecs()
+
+
+def _add_uploaded_files(files: list[Tuple[str, bytes]], status: list[FileStatus]):
+    parsed: list[list[Chunk]] = [[] for _ in files]
+    failed = set()
+    # chunks are embedded in the background as they're parsed, shared
+    # chunks between (and within) the files are embedded once
+    with ChunkEmbedder() as embedding:
+        for i, chunks in parse_files([content for _, content in files]):
+            if isinstance(chunks, Exception):
+                if status is None:
+                    raise chunks
+                failed.add(i)
+                status[i].fail(chunks)
+                continue
+            parsed[i].extend(chunks)
+            embedding.put(chunks)
+        todo = [i for i in range(len(files)) if i not in failed]
+        set_stage(status, todo, 'parsed')
+        embedding.finish()
+    set_stage(status, todo, 'embedded')
+
+    docs = []
+    with data_lock:
+        for i in todo:
+            name, chunks = files[i][0], parsed[i]
+            # Create a new document and add to the Docs instance
+            doc = Doc(id=0, title=name, chunks=chunks, tag='')
+            if data.exist(name):
+                # a new version replaces the latest doc of that title, keeping
+                # its id and tag. unchanged chunks kept their rows (and weren't
+                # embedded again), so only the changed ones touch the index
+                old = data.get(max(data.doc_ids_by_title[name]))
+                doc.id, doc.tag = old.id, old.tag
+                data.put_doc(doc)
+                if answer_cache is not None:
+                    answer_cache.invalidate(doc.id)
+            else:
+                _ = data.add_doc(doc)
+            store_doc(doc)
+            docs.append(doc)
+        faiss_add_docs(docs)
+    set_stage(status, todo, 'indexed')
+    gray(f'added {len(docs)} files')
+    maybe_compact()
+
+
+def set_stage(status: list[FileStatus], idxes: list[int], stage: str):
+    if status is not None:
+        for i in idxes:
+            status[i].stage = stage
+
+
+# uploads are queued here and ingested in the background, see /add-file
+ingest_jobs = JobQueue(lambda job, files: add_uploaded_files(files, job.files))
 
 
 def delete_file(idx: int):
-    change = False
-    for i, doc in enumerate(data.docs):
-        if doc.id == idx:
-            del data.docs[i]
-            change = True
-    if change:
-        init_faiss()
+    with data_lock:
+        if remove_doc(idx):
+            unstore_doc(idx)
+
+
+def tag_file(idx: int, tag: str):
+    with data_lock:
+        if idx in data.docs:
+            data.add_doc_tag(idx, tag)
+            if meta_store is not None:
+                meta_store.set_tag(idx, tag)
+
+
+def remove_doc(idx: int) -> bool:
+    if not data.remove_doc(idx):
+        return False
+    faiss_remove_doc(idx)
+    # an upload in flight compacts once its docs are in, see ingest_rows
+    if not ingesting and vec_store.dead * 2 > len(vec_store):
+        compact_vecs()
+    if answer_cache is not None:
+        answer_cache.invalidate(idx)
+    return True
+
+
+def compact_vecs():
+    """drop the rows of deleted chunks from vec_store, renumber every chunk
+    and rebuild the index"""
+    gray(f'compacting {vec_store.dead} dead rows')
+    rows = np.array([c.vec_idx for doc in data.docs.values()
+                    for c in doc.chunks], dtype=np.int64)
+    remap = vec_store.compact(rows)
+    for doc in data.docs.values():
+        for chunk in doc.chunks:
+            chunk.vec_idx = int(remap[chunk.vec_idx])
+    # rows renumbered, see write_data
+    data.version += 1
+    init_faiss()
 
 
 def ask_question(
@@ -509,36 +1560,92 @@ def ask_question(
         doc_ids: list[int],
         doc_tags: list[str],
         chunk_size=50) -> str:
-    chunks = search_chunk2(question, doc_tags, doc_ids, chunk_size)
-    return openai_call_completion(username, question, chunks)
+    return "".join(ask_question_stream(username, question, doc_ids, doc_tags, chunk_size))
 
 
-def filter_vec(doc_ids: list[int], doc_tags: list[str]) -> dict[int, faiss.IndexFlatL2]:
-    gray(f'filter by docs {doc_ids}, {doc_tags}')
-    filtered = []
-    if not doc_ids and doc_tags:
-        # filter only by tags
-        for doc in data.docs:
-            if doc.tag in doc_tags:
-                filtered.append(doc.id)
-    elif not doc_tags and doc_ids:
-        # filter only by ids
-        for doc in data.docs:
-            if doc.id in doc_ids:
-                filtered.append(doc.id)
-    elif not doc_ids and not doc_tags:
-        # both empty
-        filtered = [doc.id for doc in data.docs]
-    else:
-        for doc in data.docs:
-            if doc.id in doc_ids and doc.tag in doc_tags:
-                filtered.append(doc.id)
+def ask_question_stream(
+        username, question: str,
+        doc_ids: list[int],
+        doc_tags: list[str],
+        chunk_size=50) -> Iterator[str]:
+    """the answer as it's generated, a cached one in one piece. it's only
+    cached once it's complete"""
+    answer, context, entry = question_context(username, question, doc_ids, doc_tags, chunk_size)
+    if answer is not None:
+        yield answer
+        return
+    parts = []
+    for part in openai_stream_completion(username, question, context):
+        parts.append(part)
+        yield part
+    cache_answer(entry, "".join(parts))
 
-    ret = {}
-    # filter by doc_id
-    for k, v in faiss_vec_by_doc_id.items():
-        if k in filtered:
-            ret[k] = v
 
-    gray(f'filtered: {ret.keys()}')
-    return ret
+async def ask_question_astream(
+        username, question: str,
+        doc_ids: list[int],
+        doc_tags: list[str],
+        chunk_size=50) -> AsyncIterator[str]:
+    """ask_question_stream for the event loop, the embedding and search run
+    in a worker thread and the completion on async_client"""
+    answer, context, entry = await asyncio.to_thread(
+        question_context, username, question, doc_ids, doc_tags, chunk_size)
+    if answer is not None:
+        yield answer
+        return
+    parts = []
+    async for part in openai_astream_completion(username, question, context):
+        parts.append(part)
+        yield part
+    cache_answer(entry, "".join(parts))
+
+
+def question_context(
+        username, question: str,
+        doc_ids: list[int],
+        doc_tags: list[str],
+        chunk_size: int) -> Tuple[str, list[Passage], tuple]:
+    """(cached answer, context, cache entry) of a question, the blocking part
+    of answering it. there's no context with a cached answer, the entry is
+    for cache_answer"""
+    if answer_cache is None:
+        return None, search_context(question, doc_tags, doc_ids, chunk_size), None
+
+    # the question (by its embedding), the prompt and the version of every
+    # doc in the filter. not the chat history, it changes every turn
+    with data_lock.read():
+        filtered = frozenset(data.filter(doc_ids, doc_tags))
+        versions = data.versions(filtered)
+    key = content_hash(
+        data.state.prompt.get(username, default_prompt),
+        json.dumps(versions),
+        str(chunk_size))
+    question_vec = embed_questions([question])[0]
+    answer = answer_cache.get(key, question_vec)
+    if answer is not None:
+        gray('answer cache hit')
+        return answer, [], None
+    context = search_context(question, doc_tags, doc_ids, chunk_size)
+    return None, context, (key, filtered, question_vec)
+
+
+def cache_answer(entry: tuple, answer: str):
+    if entry is not None and answer_cache is not None:
+        key, filtered, question_vec = entry
+        answer_cache.put(key, filtered, question_vec, answer)
+
+
+def filter_vec(doc_ids: list[int], doc_tags: list[str]) -> np.ndarray:
+    """faiss ids of the chunks in the matching docs, None means no filter"""
+    gray(f'filter by docs {doc_ids}, {doc_tags}')
+    if not doc_ids and not doc_tags:
+        # both empty
+        return None
+    filtered = data.filter(doc_ids, doc_tags)
+
+    gray(f'filtered: {filtered}')
+    ids = [faiss_ids_by_doc_id[k]
+           for k in filtered if k in faiss_ids_by_doc_id]
+    if not ids:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(ids)